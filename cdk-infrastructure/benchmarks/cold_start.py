@@ -0,0 +1,117 @@
+## Cold-start benchmark for the search Lambda
+#
+# Imports the search handler in fresh interpreters and reports its import
+# time, broken down per module the handler imports (its own modules and
+# third party packages) from `python -X importtime`.
+# With --function-name it also reports the Init Duration of the deployed
+# function's cold starts, read from its CloudWatch REPORT lines.
+#
+#   python benchmarks/cold_start.py --runs 5
+#   python benchmarks/cold_start.py --function-name <SearchLambdaFunction name> --hours 24
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+SEARCH_LAMBDA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "simple_rag_with_access_control",
+    "lambda",
+    "search",
+)
+# Placeholders for the variables read at import time, no AWS call is made
+LAMBDA_ENVIRONMENT = {
+    "AOS_ENDPOINT": "localhost",
+    "AOS_INDEX": "cold-start-benchmark",
+    "CUSTOM_ATTRIBUTES": "department,access_level",
+    "USER_POOL_ID": "us-east-1_benchmark",
+    "USER_POOL_CLIENT_ID": "benchmark",
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+INIT_DURATION = re.compile(r"Init Duration: ([\d.]+) ms")
+
+
+def import_handler(importtime: bool = False) -> tuple[float, str]:
+    # Wall time of `import index` in a new interpreter, and its stderr
+    env = {**os.environ, **LAMBDA_ENVIRONMENT}
+    command = [sys.executable] + (["-X", "importtime"] if importtime else [])
+    command += ["-c", "import index"]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=SEARCH_LAMBDA_DIR, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.exit(f"Importing the search handler failed:\n{result.stderr}")
+    return elapsed, result.stderr
+
+
+def module_import_times(stderr: str) -> dict[str, float]:
+    # Cumulative milliseconds of each module imported by index itself, with
+    # everything it pulls in, and the time spent running index's own body
+    times = {}
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        if name == "index" and len(indent) == 1:
+            times["index (module body)"] = int(self_us) / 1000
+        elif len(indent) == 3:
+            times[name] = times.get(name, 0.0) + int(cumulative_us) / 1000
+    return times
+
+
+def report_local(runs: int, top: int) -> None:
+    wall_times = [import_handler()[0] * 1000 for _ in range(runs)]
+    print(
+        f"Handler import over {runs} runs (interpreter start included): "
+        f"median {statistics.median(wall_times):.0f} ms, max {max(wall_times):.0f} ms"
+    )
+    times = module_import_times(import_handler(importtime=True)[1])
+    print(f"\nTop {top} modules imported by the handler, by cumulative import time:")
+    for name, ms in sorted(times.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"  {ms:9.1f} ms  {name}")
+
+
+def report_deployed(function_name: str, hours: float) -> None:
+    import boto3
+
+    logs = boto3.client("logs")
+    paginator = logs.get_paginator("filter_log_events")
+    durations = []
+    for page in paginator.paginate(
+        logGroupName=f"/aws/lambda/{function_name}",
+        startTime=int((time.time() - hours * 3600) * 1000),
+        filterPattern='"Init Duration"',
+    ):
+        for event in page["events"]:
+            match = INIT_DURATION.search(event["message"])
+            if match:
+                durations.append(float(match.group(1)))
+    if not durations:
+        print(f"\nNo cold start of {function_name} in the last {hours} hours")
+        return
+    durations.sort()
+    print(
+        f"\n{len(durations)} cold starts of {function_name} in the last {hours} hours, "
+        f"Init Duration median {statistics.median(durations):.0f} ms, "
+        f"p90 {durations[int(0.9 * (len(durations) - 1))]:.0f} ms, max {durations[-1]:.0f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search Lambda cold-start benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--function-name", help="Deployed search Lambda to read cold starts of")
+    parser.add_argument("--hours", type=float, default=24)
+    args = parser.parse_args()
+
+    report_local(args.runs, args.top)
+    if args.function_name:
+        report_deployed(args.function_name, args.hours)
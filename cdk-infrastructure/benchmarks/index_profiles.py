@@ -0,0 +1,187 @@
+## Recall, latency and memory of the index profiles
+#
+# Embeds the documents of an index snapshot (see the ingestion "snapshot"
+# option) at the dimension of every profile, loads them into a temporary
+# index per profile and runs pseudo-queries (a sentence of sampled
+# documents) against it. Recall is measured against an exact brute-force
+# search of the same vectors, and against the exact top k of the
+# 1024-dimension vectors to show what a smaller dimension costs. Memory is
+# the faiss graph size reported by the k-NN plugin after warmup, next to
+# the usual estimate of 1.1 * (bytes per vector + 8 * m) * documents.
+#
+#   python benchmarks/index_profiles.py --endpoint <domain endpoint> --snapshot /tmp/snapshot
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+
+LAMBDA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "simple_rag_with_access_control"
+)
+sys.path.insert(0, os.path.join(LAMBDA_DIR, "lambda", "ingestion"))
+os.environ.setdefault("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION", "us-east-1"))
+
+import boto3  # noqa: E402
+from opensearchpy import AWSV4SignerAuth, OpenSearch, RequestsHttpConnection, helpers  # noqa: E402
+
+import chunking  # noqa: E402
+import profiles  # noqa: E402
+from embedding import ParallelEmbedder  # noqa: E402
+from snapshot import Snapshot  # noqa: E402
+
+VECTOR_BYTES = {"flat": 4, "sq_fp16": 2}
+
+
+def create_os_client(endpoint: str, region: str) -> OpenSearch:
+    auth = AWSV4SignerAuth(boto3.Session().get_credentials(), region, "es")
+    return OpenSearch(
+        hosts=[{"host": endpoint, "port": 443}],
+        http_auth=auth,
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection,
+        timeout=120,
+    )
+
+
+def embed_all(texts: list[str], model_id: str, dimension: int) -> np.ndarray:
+    embedder = ParallelEmbedder("bedrock", model_id, dimensions=dimension)
+    try:
+        docs = ((str(i), {"doc_text": text}) for i, text in enumerate(texts))
+        return np.array(
+            [doc["doc_embedding"] for _, doc in embedder.embed_documents(docs)], dtype=np.float32
+        )
+    finally:
+        embedder.close()
+
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    # Rows of the k nearest vectors by L2 distance, nearest first
+    distances = (
+        (queries**2).sum(axis=1)[:, None] - 2 * queries @ vectors.T + (vectors**2).sum(axis=1)[None, :]
+    )
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(distances, top, axis=1).argsort(axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def recall(found: list[list[int]], expected: np.ndarray) -> float:
+    return float(np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, expected)]))
+
+
+def graph_memory_kb(os_client, index_name: str) -> float:
+    stats = os_client.transport.perform_request("GET", "/_plugins/_knn/stats")
+    return sum(
+        node.get("indices_in_cache", {}).get(index_name, {}).get("graph_memory_usage", 0)
+        for node in stats["nodes"].values()
+    )
+
+
+def benchmark_profile(
+    os_client, name: str, profile: dict, vectors: np.ndarray, queries: np.ndarray, k: int, shards: int
+) -> tuple[list[list[int]], dict]:
+    index_name = f"profile-benchmark-{name}"
+    body = profiles.apply_profile(
+        {
+            "settings": {"number_of_shards": shards, "number_of_replicas": 0, "index.knn": True},
+            "mappings": {"properties": {}},
+        },
+        {"name": name, **profile},
+    )
+    if os_client.indices.exists(index=index_name):
+        os_client.indices.delete(index=index_name)
+    os_client.indices.create(index=index_name, body=body)
+    try:
+        helpers.bulk(
+            os_client,
+            (
+                {"_index": index_name, "_id": str(row), "doc_embedding": vector.tolist()}
+                for row, vector in enumerate(vectors)
+            ),
+            chunk_size=200,
+        )
+        os_client.indices.refresh(index=index_name)
+        # One segment per shard so every profile is measured on a single graph
+        os_client.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=900)
+        os_client.transport.perform_request("GET", f"/_plugins/_knn/warmup/{index_name}")
+
+        found, took, wall = [], [], []
+        for query in queries:
+            start = time.perf_counter()
+            response = os_client.search(
+                index=index_name,
+                body={
+                    "size": k,
+                    "_source": False,
+                    "query": {"knn": {"doc_embedding": {"vector": query.tolist(), "k": k}}},
+                },
+            )
+            wall.append((time.perf_counter() - start) * 1000)
+            took.append(response["took"])
+            found.append([int(hit["_id"]) for hit in response["hits"]["hits"]])
+
+        bytes_per_vector = VECTOR_BYTES[profile["encoder"]] * profile["dimension"]
+        return found, {
+            "took_p50_ms": statistics.median(took),
+            "took_p95_ms": sorted(took)[int(0.95 * (len(took) - 1))],
+            "client_p50_ms": round(statistics.median(wall), 1),
+            "graph_memory_kb": graph_memory_kb(os_client, index_name),
+            "estimated_memory_kb": round(1.1 * (bytes_per_vector + 8 * profile["m"]) * len(vectors) / 1024),
+        }
+    finally:
+        os_client.indices.delete(index=index_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index profile benchmark")
+    parser.add_argument("--endpoint", required=True, help="OpenSearch domain endpoint")
+    parser.add_argument("--region", default=os.environ["AWS_REGION"])
+    parser.add_argument("--snapshot", required=True, help="Local snapshot directory to take documents from")
+    parser.add_argument("--profiles", nargs="*", help="Profile names, all by default")
+    parser.add_argument("--model-id", default="amazon.titan-embed-text-v2:0")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(os.path.join(LAMBDA_DIR, "index_profiles.json"), "r") as file:
+        all_profiles = json.load(file)
+    selected = {name: all_profiles[name] for name in args.profiles or all_profiles}
+
+    texts = Snapshot(args.snapshot).docs["texts"]
+    rng = random.Random(args.seed)
+    sentences = []
+    for text in rng.sample(texts, min(args.queries, len(texts))):
+        candidates = chunking.split_sentences(text)
+        sentences.append(rng.choice(candidates) if candidates else text)
+
+    os_client = create_os_client(args.endpoint, args.region)
+    embeddings = {}
+    reference = None
+    results = {}
+    for dimension in sorted({1024} | {p["dimension"] for p in selected.values()}, reverse=True):
+        vectors = embed_all(texts, args.model_id, dimension)
+        queries = embed_all(sentences, args.model_id, dimension)
+        embeddings[dimension] = (vectors, queries, exact_top_k(vectors, queries, args.k))
+        if dimension == 1024:
+            reference = embeddings[dimension][2]
+
+    for name, profile in selected.items():
+        vectors, queries, exact = embeddings[profile["dimension"]]
+        found, metrics = benchmark_profile(
+            os_client, name, profile, vectors, queries, args.k, args.shards
+        )
+        results[name] = {
+            f"recall@{args.k}": round(recall(found, exact), 4),
+            f"recall@{args.k}_vs_1024_exact": round(recall(found, reference), 4),
+            **metrics,
+        }
+        print(f"{name}: {results[name]}")
+
+    print(json.dumps({"documents": len(texts), "queries": len(sentences), "results": results}, indent=2))
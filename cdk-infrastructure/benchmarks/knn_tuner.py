@@ -0,0 +1,189 @@
+## Filtered kNN tuner: recall and latency by entitlement selectivity
+#
+# Builds synthetic users whose ACL filter lets through a given share of the
+# index, from the ACL table of an index snapshot (see the ingestion
+# "snapshot" option, preferably with dtype float32). For every user and
+# every k of the grid it runs filtered kNN queries (a sentence of sampled
+# documents, embedded at the snapshot dimension) against the index and
+# measures recall against an exact search of the allowed rows of the
+# snapshot, latency and the share of queries returning fewer hits than
+# asked for. It then writes the policy the search Lambda reads (see
+# knn_policy.py): per selectivity band, the smallest k reaching the target
+# recall.
+#
+#   python benchmarks/knn_tuner.py --endpoint <domain endpoint> --index unicorn-robotics \
+#       --snapshot /tmp/snapshot --bucket <data bucket>
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+
+import numpy as np
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "simple_rag_with_access_control",
+        "lambda",
+        "ingestion",
+    ),
+)
+os.environ.setdefault("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION", "us-east-1"))
+
+import boto3  # noqa: E402
+
+import chunking  # noqa: E402
+from snapshot import Snapshot  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from index_profiles import create_os_client, embed_all  # noqa: E402
+
+MSEARCH_BATCH = 50
+
+
+def synthetic_users(snapshot: Snapshot, selectivities: list[float]) -> list[dict]:
+    # For each target, values of the attribute with the most values, rarest
+    # first, until the target share of rows is reached
+    attr, table = max(snapshot.acl.items(), key=lambda item: len(item[1]["values"]))
+    rows_by_value = [[] for _ in table["values"]]
+    for row, codes in enumerate(table["rows"]):
+        for code in codes:
+            rows_by_value[code].append(row)
+    order = sorted(range(len(table["values"])), key=lambda code: len(rows_by_value[code]))
+
+    users = []
+    for target in sorted(selectivities):
+        allowed = np.zeros(snapshot.count, dtype=bool)
+        values = []
+        for code in order:
+            if values and allowed.mean() >= target:
+                break
+            values.append(table["values"][code])
+            allowed[rows_by_value[code]] = True
+        users.append(
+            {
+                "target": target,
+                "selectivity": round(float(allowed.mean()), 4),
+                "filter": {"bool": {"filter": [{"terms": {attr: values}}]}},
+                "allowed": np.flatnonzero(allowed),
+            }
+        )
+    return users
+
+
+def exact_hits(vectors: np.ndarray, allowed: np.ndarray, queries: np.ndarray, size: int) -> list[set]:
+    candidates = vectors[allowed]
+    distances = (
+        (queries**2).sum(axis=1)[:, None]
+        - 2 * queries @ candidates.T
+        + (candidates**2).sum(axis=1)[None, :]
+    )
+    size = min(size, len(allowed))
+    top = np.argpartition(distances, size - 1, axis=1)[:, :size]
+    return [set(allowed[row].tolist()) for row in top]
+
+
+def measure(
+    os_client, index_name: str, snapshot: Snapshot, user: dict, queries, exact, k: int, size: int
+) -> dict:
+    found, took = [], []
+    for start in range(0, len(queries), MSEARCH_BATCH):
+        body = []
+        for query in queries[start : start + MSEARCH_BATCH]:
+            body.extend(
+                [
+                    {"index": index_name},
+                    {
+                        "size": size,
+                        "_source": False,
+                        "query": {
+                            "knn": {
+                                "doc_embedding": {
+                                    "vector": query.tolist(),
+                                    "k": max(k, size),
+                                    "filter": user["filter"],
+                                }
+                            }
+                        },
+                    },
+                ]
+            )
+        for response in os_client.msearch(body=body)["responses"]:
+            took.append(response["took"])
+            hits = response["hits"]["hits"]
+            found.append({snapshot.rows[hit["_id"]] for hit in hits if hit["_id"] in snapshot.rows})
+
+    expected_hits = min(size, len(user["allowed"]))
+    return {
+        "k": k,
+        "recall": round(float(np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])), 4),
+        "short_rate": round(float(np.mean([len(f) < expected_hits for f in found])), 4),
+        "took_p50_ms": statistics.median(took),
+        "took_p95_ms": sorted(took)[int(0.95 * (len(took) - 1))],
+    }
+
+
+def build_policy(results: list[dict], target_recall: float, k_grid: list[int]) -> dict:
+    # Band i covers the selectivities up to the i-th user's. It gets the larger
+    # of the k chosen for that user and for the next narrower one, since
+    # narrower filters need the larger k.
+    chosen = []
+    for result in results:
+        passing = [m["k"] for m in result["measurements"] if m["recall"] >= target_recall]
+        chosen.append(min(passing) if passing else max(k_grid))
+    bands = []
+    for position, result in enumerate(results):
+        k = max(chosen[max(position - 1, 0)], chosen[position])
+        bands.append({"max_selectivity": result["selectivity"], "k": k})
+    bands[-1]["max_selectivity"] = 1.0
+    return {"bands": bands, "widen_factor": 4, "max_k": max(k_grid)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Filtered kNN tuner")
+    parser.add_argument("--endpoint", required=True, help="OpenSearch domain endpoint")
+    parser.add_argument("--region", default=os.environ["AWS_REGION"])
+    parser.add_argument("--index", required=True)
+    parser.add_argument("--snapshot", required=True, help="Local snapshot directory of the index")
+    parser.add_argument("--model-id", default="amazon.titan-embed-text-v2:0")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--size", type=int, default=5)
+    parser.add_argument("--k-grid", default="10,20,40,100,200,400")
+    parser.add_argument("--selectivities", default="0.002,0.01,0.05,0.2,0.5,1.0")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--bucket", help="Data bucket to write <index>-knn-policy.json to")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    snapshot = Snapshot(args.snapshot)
+    vectors = snapshot.dequantize(np.arange(snapshot.count))
+    rng = random.Random(args.seed)
+    sentences = []
+    for text in rng.sample(snapshot.docs["texts"], min(args.queries, snapshot.count)):
+        candidates = chunking.split_sentences(text)
+        sentences.append(rng.choice(candidates) if candidates else text)
+    queries = embed_all(sentences, args.model_id, snapshot.header["dimension"])
+
+    os_client = create_os_client(args.endpoint, args.region)
+    k_grid = [int(k) for k in args.k_grid.split(",")]
+    results = []
+    for user in synthetic_users(snapshot, [float(s) for s in args.selectivities.split(",")]):
+        exact = exact_hits(vectors, user["allowed"], queries, args.size)
+        measurements = [
+            measure(os_client, args.index, snapshot, user, queries, exact, k, args.size) for k in k_grid
+        ]
+        results.append({"selectivity": user["selectivity"], "measurements": measurements})
+        print(f"selectivity {user['selectivity']} (target {user['target']}):")
+        for m in measurements:
+            print(f"  {m}")
+
+    policy = build_policy(results, args.target_recall, k_grid)
+    print(json.dumps(policy, indent=2))
+    if args.bucket:
+        key = f"{args.index}-knn-policy.json"
+        boto3.client("s3").put_object(Bucket=args.bucket, Key=key, Body=json.dumps(policy).encode("utf-8"))
+        print(f"Policy written to s3://{args.bucket}/{key}")
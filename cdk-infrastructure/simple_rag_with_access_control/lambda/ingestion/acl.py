@@ -0,0 +1,81 @@
+## ACL attribute normalization and vocabulary
+import os
+
+# "keyword" indexes the normalized values, "integer" their dictionary codes
+acl_encoding = os.environ.get("ACL_ENCODING", "keyword")
+# Vocabulary key of the total document count, not an attribute
+DOCUMENTS_KEY = "_documents"
+# Vocabulary key of the number of indexed vectors, one per passage when chunked
+PASSAGES_KEY = "_passages"
+# ACL attribute documents are routed by, none when empty
+routing_attribute = os.environ.get("ROUTING_ATTRIBUTE", "")
+# Routing key of documents without exactly one value of the routing attribute,
+# searched by every user along with the keys of their own values
+SHARED_ROUTING = "_shared"
+
+
+def normalize_acl_values(value) -> list[str]:
+    # Trimmed, case-folded, deduplicated values. Strings are split on commas,
+    # the same way the search Lambda splits the Cognito attributes.
+    if value is None:
+        return []
+    items = value.split(",") if isinstance(value, str) else value
+    if not isinstance(items, list):
+        items = [items]
+    return sorted({str(item).strip().casefold() for item in items} - {""})
+
+
+def routing_key(metadata: dict) -> str:
+    # Routing of a normalized document, None when routing is off
+    if not routing_attribute:
+        return None
+    values = metadata.get(routing_attribute) or []
+    return str(values[0]) if len(values) == 1 else SHARED_ROUTING
+
+
+def get_mapping_type() -> str:
+    return "integer" if acl_encoding == "integer" else "keyword"
+
+
+class AclVocabulary:
+    """Per-attribute dictionary of ACL values with document counts.
+
+    Codes are stable across runs when the previous vocabulary is loaded, so
+    documents indexed by earlier runs keep matching. The total number of
+    documents is kept under DOCUMENTS_KEY, for the search Lambda to estimate
+    the share of the index a user may read, and the number of passages under
+    PASSAGES_KEY, to turn that share into a number of kNN candidates.
+    """
+
+    def __init__(self, attributes: list[str], previous: dict = None):
+        self.entries = {attr: {} for attr in attributes}
+        self.documents = 0
+        self.passages = None
+        for attr, values in (previous or {}).items():
+            if attr in self.entries:
+                for value, entry in values.items():
+                    self.entries[attr][value] = {"code": entry["code"], "doc_count": 0}
+
+    def add(self, attr: str, values: list[str]) -> list:
+        # Counts the values of one document and returns what gets indexed
+        entries = self.entries[attr]
+        for value in values:
+            if value not in entries:
+                entries[value] = {"code": len(entries), "doc_count": 0}
+            entries[value]["doc_count"] += 1
+        if acl_encoding == "integer":
+            return [entries[value]["code"] for value in values]
+        return values
+
+    def to_dict(self) -> dict:
+        counts = {DOCUMENTS_KEY: self.documents}
+        if self.passages is not None:
+            counts[PASSAGES_KEY] = self.passages
+        return {**self.entries, **counts}
+
+
+def normalize_metadata(metadata: dict, vocabulary: AclVocabulary) -> dict:
+    for attr in vocabulary.entries:
+        if attr in metadata:
+            metadata[attr] = vocabulary.add(attr, normalize_acl_values(metadata[attr]))
+    return metadata
@@ -0,0 +1,114 @@
+## Streaming documents out of a zip archive on S3 or local disk
+import io
+import json
+import logging
+import os
+import posixpath
+import zipfile
+from typing import Iterator
+
+import acl
+
+logger = logging.getLogger()
+
+# Size of each ranged GET, members are read in archive order so most reads
+# are served from the current block
+READ_AHEAD_BYTES = 8 * 1024 * 1024
+
+
+class S3RangeReader(io.RawIOBase):
+    """Seekable read-only view of an S3 object backed by ranged GETs."""
+
+    def __init__(self, s3_client, bucket: str, key: str):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size:
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        response = self.s3_client.get_object(
+            Bucket=self.bucket, Key=self.key, Range=f"bytes={self.position}-{end}"
+        )
+        data = response["Body"].read()
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def open_archive(s3_client, bucket: str, file_name: str) -> zipfile.ZipFile:
+    # A local copy is used when present (local runs), otherwise the archive is
+    # read in place on S3 without touching /tmp
+    if os.path.exists(file_name):
+        return zipfile.ZipFile(file_name, "r")
+    reader = S3RangeReader(s3_client, bucket, file_name)
+    return zipfile.ZipFile(io.BufferedReader(reader, READ_AHEAD_BYTES), "r")
+
+
+def _document_members(archive: zipfile.ZipFile, prefix: str) -> list[zipfile.ZipInfo]:
+    # Members directly under prefix, in archive order, without macOS metadata
+    members = []
+    for info in archive.infolist():
+        name = info.filename
+        if (
+            info.is_dir()
+            or name.startswith("__MACOSX/")
+            or posixpath.basename(name).startswith(".")
+            or posixpath.dirname(name) != prefix
+        ):
+            continue
+        members.append(info)
+    return members
+
+
+def iter_documents(
+    archive: zipfile.ZipFile, prefix: str, vocabulary: acl.AclVocabulary
+) -> Iterator[tuple[str, dict]]:
+    # Yields (doc id, document) pairs one at a time. Metadata files are small
+    # and read first, in one sequential pass, so that text files can then be
+    # streamed in archive order wherever their metadata is stored.
+    members = _document_members(archive, prefix)
+    metadata_by_stem = {}
+    for info in members:
+        if info.filename.endswith(".json"):
+            stem = posixpath.splitext(posixpath.basename(info.filename))[0]
+            metadata_by_stem[stem] = json.loads(archive.read(info))
+
+    for info in members:
+        if not info.filename.endswith(".txt"):
+            continue
+        filename = posixpath.basename(info.filename)
+        doc = {"doc_text": archive.read(info).decode("utf-8")}
+
+        # Read metadata from associated JSON file
+        metadata = metadata_by_stem.pop(posixpath.splitext(filename)[0], None)
+        if metadata is not None:
+            doc.update(acl.normalize_metadata(metadata, vocabulary))
+        else:
+            logger.warning(f"No metadata file found for {filename}")
+
+        vocabulary.documents += 1
+        yield filename, doc
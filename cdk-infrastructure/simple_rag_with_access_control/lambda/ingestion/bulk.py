@@ -0,0 +1,139 @@
+## Byte-size-aware bulk indexing with retries
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from opensearchpy import OpenSearch
+from opensearchpy.exceptions import ConnectionError, TransportError
+
+logger = logging.getLogger()
+
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+# Item errors kept in the summary, the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+
+class BulkIndexer:
+    """Buffers bulk actions and sends them when a doc count or byte budget is hit.
+
+    Up to `parallel_requests` bulk requests are in flight at once. Items
+    rejected with a retryable status (429, 503, ...) are resent with jittered
+    exponential backoff; every other item error is reported in the summary.
+    """
+
+    def __init__(
+        self,
+        os_client: OpenSearch,
+        max_docs: int = 500,
+        max_bytes: int = 5 * 1024 * 1024,
+        parallel_requests: int = 2,
+        max_retries: int = 5,
+    ):
+        self.os_client = os_client
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=parallel_requests)
+        # Bounds the batches waiting for a worker, and therefore the memory held
+        self.slots = threading.BoundedSemaphore(parallel_requests * 2)
+        self.futures = []
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.lock = threading.Lock()
+        self.summary = {"indexed": 0, "failed": 0, "retried": 0, "requests": 0, "errors": []}
+        self.failed_ids = set()
+
+    def add(self, action: dict, source: dict = None) -> None:
+        # action is a bulk action line such as {"index": {"_index": ..., "_id": ...}},
+        # source the document line that follows it, None for deletes
+        entry = (
+            json.dumps(action),
+            json.dumps(source) if source is not None else None,
+        )
+        size = sum(len(line.encode("utf-8")) + 1 for line in entry if line is not None)
+        if self.buffer and (
+            len(self.buffer) >= self.max_docs or self.buffer_bytes + size > self.max_bytes
+        ):
+            self.flush()
+        self.buffer.append(entry)
+        self.buffer_bytes += size
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        batch, self.buffer, self.buffer_bytes = self.buffer, [], 0
+        self.slots.acquire()
+        future = self.executor.submit(self._send, batch)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def close(self) -> dict:
+        self.flush()
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown(wait=True)
+        logger.info(
+            f"Bulk indexing summary: indexed {self.summary['indexed']}, "
+            f"failed {self.summary['failed']}, retried {self.summary['retried']}, "
+            f"in {self.summary['requests']} requests"
+        )
+        return self.summary
+
+    def _send(self, batch: list[tuple]) -> None:
+        for attempt in range(self.max_retries + 1):
+            body = "".join(
+                f"{action}\n" if source is None else f"{action}\n{source}\n"
+                for action, source in batch
+            )
+            try:
+                with self.lock:
+                    self.summary["requests"] += 1
+                response = self.os_client.bulk(body=body)
+                batch = self._collect_results(batch, response["items"])
+            except (ConnectionError, TransportError) as e:
+                # The whole request failed, e.g. 429 from the domain or a timeout
+                status = getattr(e, "status_code", None)
+                if status not in RETRYABLE_STATUSES and not isinstance(e, ConnectionError):
+                    self._record_failures(batch, str(e))
+                    return
+                logger.warning(f"Bulk request failed, will retry: {str(e)}")
+
+            if not batch:
+                return
+            if attempt < self.max_retries:
+                with self.lock:
+                    self.summary["retried"] += len(batch)
+                time.sleep(min(30.0, 2**attempt) * random.uniform(0.5, 1.0))
+
+        self._record_failures(batch, "Retries exhausted")
+
+    def _collect_results(self, batch: list[tuple], items: list[dict]) -> list[tuple]:
+        # Bulk items come back in request order. Returns the entries to resend.
+        retry = []
+        with self.lock:
+            for entry, item in zip(batch, items):
+                operation, result = next(iter(item.items()))
+                status = result.get("status", 500)
+                if status < 300 or (operation == "delete" and status == 404):
+                    self.summary["indexed"] += 1
+                elif status in RETRYABLE_STATUSES:
+                    retry.append(entry)
+                else:
+                    self._record_failure(result.get("_id"), result.get("error"))
+        return retry
+
+    def _record_failures(self, batch: list[tuple], error) -> None:
+        with self.lock:
+            for action, _ in batch:
+                operation = next(iter(json.loads(action).values()))
+                self._record_failure(operation.get("_id"), error)
+
+    def _record_failure(self, doc_id: str, error) -> None:
+        self.summary["failed"] += 1
+        self.failed_ids.add(doc_id)
+        if len(self.summary["errors"]) < MAX_REPORTED_ERRORS:
+            self.summary["errors"].append({"_id": doc_id, "error": error})
+            logger.error(f"Failed to index document {doc_id}: {error}")
@@ -0,0 +1,98 @@
+## Relevance score calibration for the search Lambda's retrieval gate
+import logging
+import random
+
+import numpy as np
+
+import chunking
+
+logger = logging.getLogger()
+
+
+def sample_queries(os_client, index_name: str, sample_size: int, seed: int) -> list[tuple]:
+    # One sentence of randomly chosen documents, paired with the id of the
+    # document (or parent document, when chunked) it was taken from
+    response = os_client.search(
+        index=index_name,
+        body={
+            "size": sample_size,
+            "_source": ["doc_text", "parent_id"],
+            "query": {"function_score": {"random_score": {"seed": seed, "field": "_seq_no"}}},
+        },
+    )
+    rng = random.Random(seed)
+    queries = []
+    for hit in response["hits"]["hits"]:
+        sentences = [s for s in chunking.split_sentences(hit["_source"]["doc_text"]) if len(s) > 40]
+        if sentences:
+            source_id = hit["_source"].get("parent_id") or hit["_id"]
+            queries.append((rng.choice(sentences), source_id))
+    return queries
+
+
+def calibrate_scores(
+    os_client,
+    embedder,
+    index_name: str,
+    sample_size: int = 50,
+    unrelated_percentile: float = 95,
+    min_recall: float = 0.9,
+    questions: list[dict] = None,
+    seed: int = 0,
+) -> dict:
+    # kNN scores of the document a query is about (relevant) against those of
+    # every other document returned (unrelated). Queries are the labelled
+    # {"question": ..., "doc_id": ...} pairs when given, otherwise sentences of
+    # sampled documents. Verbatim sentences score far above real questions, so
+    # the threshold is the `unrelated_percentile` of the unrelated scores.
+    # It is only accepted when it keeps `min_recall` of the relevant hits.
+    if questions:
+        queries = [(question["question"], question["doc_id"]) for question in questions]
+    else:
+        queries = sample_queries(os_client, index_name, sample_size, seed)
+    relevant, unrelated = [], []
+    for query, source_id in queries:
+        response = os_client.search(
+            index=index_name,
+            body={
+                "size": 10,
+                "_source": ["parent_id"],
+                "query": {"knn": {"doc_embedding": {"vector": embedder.embed(query), "k": 10}}},
+            },
+        )
+        for hit in response["hits"]["hits"]:
+            hit_source = hit["_source"].get("parent_id") or hit["_id"]
+            (relevant if hit_source == source_id else unrelated).append(hit["_score"])
+
+    if not relevant or not unrelated:
+        raise ValueError(f"Not enough hits found while calibrating index {index_name}")
+    relevant, unrelated = np.array(relevant), np.array(unrelated)
+    threshold = float(np.percentile(unrelated, unrelated_percentile))
+    # Share of relevant hits the threshold lets through
+    recall = float(np.mean(relevant > threshold))
+    calibration = {
+        "threshold": round(threshold, 4),
+        "accepted": recall >= min_recall,
+        "unrelated_percentile": unrelated_percentile,
+        "queries": len(queries),
+        "labelled": bool(questions),
+        "relevant": {
+            "count": len(relevant),
+            "median": round(float(np.median(relevant)), 4),
+            "recall": round(recall, 4),
+        },
+        "unrelated": {
+            "count": len(unrelated),
+            "median": round(float(np.median(unrelated)), 4),
+            # Share of unrelated hits the threshold still lets through
+            "above_threshold": round(float(np.mean(unrelated > threshold)), 4),
+        },
+    }
+    if calibration["accepted"]:
+        logger.info(f"Score calibration for index {index_name}: {calibration}")
+    else:
+        logger.warning(
+            f"Score calibration for index {index_name} keeps less than {min_recall} of the "
+            f"relevant hits, the search Lambda keeps its default threshold: {calibration}"
+        )
+    return calibration
@@ -0,0 +1,47 @@
+## Passage chunking
+import re
+
+# Split after sentence punctuation or on blank lines
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
+
+def split_sentences(text: str) -> list[str]:
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+
+def split_passages(text: str, max_chars: int = 1500, overlap_chars: int = 200) -> list[str]:
+    # Packs whole sentences into passages of at most max_chars. Each passage
+    # starts with the trailing sentences of the previous one, up to
+    # overlap_chars. Sentences longer than max_chars are cut on whitespace.
+    sentences = []
+    for sentence in split_sentences(text):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            sentences.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            sentences.append(sentence)
+
+    passages = []
+    current = []
+    length = 0
+    for sentence in sentences:
+        if current and length + len(sentence) + 1 > max_chars:
+            passages.append(" ".join(current))
+            overlap = []
+            overlap_length = 0
+            for previous in reversed(current):
+                if overlap_length + len(previous) + 1 > overlap_chars:
+                    break
+                overlap.insert(0, previous)
+                overlap_length += len(previous) + 1
+            # Keep room for the sentence that did not fit
+            while overlap and overlap_length + len(sentence) + 1 > max_chars:
+                overlap_length -= len(overlap.pop(0)) + 1
+            current, length = overlap, overlap_length
+        current.append(sentence)
+        length += len(sentence) + 1
+    if current:
+        passages.append(" ".join(current))
+    return passages or [text]
@@ -0,0 +1,165 @@
+## Parallel, rate-aware document embedding
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from vector_store import EmbeddingStore, text_digest
+
+logger = logging.getLogger()
+region = os.environ["AWS_REGION"]
+
+THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException")
+
+
+class ParallelEmbedder:
+    """Embeds documents on a bounded worker pool with adaptive concurrency.
+
+    Concurrency grows by one after every `max_workers` successful calls and
+    is halved on each throttling error, which is retried with jittered
+    exponential backoff.
+    """
+
+    def __init__(
+        self,
+        model_provider: str,
+        model_id: str,
+        max_workers: int = 8,
+        max_retries: int = 8,
+        dimensions: int = 1024,
+        store: EmbeddingStore = None,
+    ):
+        if model_provider != "bedrock":
+            raise ValueError(f"Model provider {model_provider} is not supported.")
+        self.model_id = model_id
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.dimensions = dimensions
+        # Embeddings of texts seen by earlier runs are read from here first
+        self.store = store
+        # A single client shared by all workers. Throttling is handled here,
+        # so botocore must not retry on its own.
+        self.bedrock_runtime = boto3.client(
+            "bedrock-runtime",
+            region_name=region,
+            config=Config(
+                max_pool_connections=max_workers,
+                retries={"total_max_attempts": 1},
+            ),
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.concurrency = max_workers
+        self.in_flight = 0
+        self.successes_since_change = 0
+        self.condition = threading.Condition()
+        self.embedded = 0
+        self.retries = 0
+        self.throttles = 0
+        self.started_at = time.monotonic()
+
+    def _acquire(self) -> None:
+        with self.condition:
+            while self.in_flight >= self.concurrency:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def _release(self, outcome: str) -> None:
+        # outcome is "success", "throttled" or "failed"
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == "throttled":
+                self.throttles += 1
+                self.successes_since_change = 0
+                self.concurrency = max(1, self.concurrency // 2)
+            elif outcome == "success":
+                self.embedded += 1
+                self.successes_since_change += 1
+                if (
+                    self.successes_since_change >= self.max_workers
+                    and self.concurrency < self.max_workers
+                ):
+                    self.concurrency += 1
+                    self.successes_since_change = 0
+            self.condition.notify_all()
+
+    def embed(self, text: str) -> list[float]:
+        if self.store is not None:
+            digest = text_digest(text)
+            embedding = self.store.get(digest)
+            if embedding is None:
+                embedding = self._invoke(text)
+                self.store.put(digest, embedding)
+            return embedding
+        return self._invoke(text)
+
+    def _invoke(self, text: str) -> list[float]:
+        body = json.dumps({"inputText": text, "dimensions": self.dimensions})
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                response = self.bedrock_runtime.invoke_model(
+                    body=body,
+                    modelId=self.model_id,
+                    accept="*/*",
+                    contentType="application/json",
+                )
+                embedding = json.loads(response.get("body").read()).get("embedding")
+            except ClientError as e:
+                throttled = e.response["Error"]["Code"] in THROTTLING_ERRORS
+                self._release("throttled" if throttled else "failed")
+                if not throttled or attempt == self.max_retries:
+                    raise
+                with self.condition:
+                    self.retries += 1
+                time.sleep(min(20.0, 0.5 * 2**attempt) * random.uniform(0.5, 1.0))
+                continue
+            except Exception:
+                self._release("failed")
+                raise
+            self._release("success")
+            return embedding
+
+    def embed_documents(
+        self, docs: Iterable[tuple[str, dict]]
+    ) -> Iterator[tuple[str, dict]]:
+        # Sets "doc_embedding" from "doc_text" and yields the (doc id, document)
+        # pairs in input order, reading at most two batches of workers ahead
+        pending = deque()
+        for doc_id, doc in docs:
+            future = self.executor.submit(self.embed, doc["doc_text"])
+            pending.append((doc_id, doc, future))
+            if len(pending) >= 2 * self.max_workers:
+                yield self._complete(*pending.popleft())
+        while pending:
+            yield self._complete(*pending.popleft())
+
+    @staticmethod
+    def _complete(doc_id: str, doc: dict, future) -> tuple[str, dict]:
+        doc["doc_embedding"] = future.result()
+        return doc_id, doc
+
+    def report(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        stats = {
+            "embedded": self.embedded,
+            "elapsed_seconds": round(elapsed, 1),
+            "docs_per_second": round(self.embedded / elapsed, 2) if elapsed else 0.0,
+            "retries": self.retries,
+            "throttles": self.throttles,
+            "final_concurrency": self.concurrency,
+            "store_hits": self.store.hits if self.store is not None else 0,
+        }
+        logger.info(f"Embedding summary: {stats}")
+        return stats
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
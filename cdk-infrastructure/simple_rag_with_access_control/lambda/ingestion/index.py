@@ -1,11 +1,27 @@
 import json
 import logging
 import os
-import zipfile
+import shutil
+import time
+from typing import Iterator
 
 import boto3
 from opensearchpy import AWSV4SignerAuth, OpenSearch, RequestsHttpConnection
 
+import acl
+import archive
+import calibration
+import chunking
+import manifest
+import profiles
+import s3_objects
+import snapshot
+from bulk import BulkIndexer
+from embedding import ParallelEmbedder
+from manifest import Manifest
+from snapshot import Snapshot, SnapshotWriter
+from vector_store import EmbeddingStore
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -17,6 +33,10 @@ bucket_name = os.environ["BUCKET_NAME"]
 region = os.environ["AWS_REGION"]
 domain_endpoint = os.environ["AOS_ENDPOINT"]
 custom_attributes = os.environ["CUSTOM_ATTRIBUTES"]
+# Vector dimension and HNSW parameters, shared with the search Lambda
+index_profile = profiles.load_profile()
+# Documents per delete by query when removing the old copies of moved documents
+MOVED_DELETE_BATCH = 500
 
 
 # Helper function to load JSON from S3
@@ -25,10 +45,33 @@ def load_json_from_s3(filename: str) -> dict:
     return json.loads(file["Body"].read().decode("utf-8"))
 
 
+def load_acl_vocabulary(filename: str) -> acl.AclVocabulary:
+    # Reuse the codes of the previous run, if any
+    try:
+        previous = load_json_from_s3(filename)
+    except Exception as e:
+        if not s3_objects.is_missing(e):
+            raise
+        logger.info(f"No ACL vocabulary at s3://{bucket_name}/{filename}, starting a new one")
+        previous = None
+    return acl.AclVocabulary(custom_attributes.split(","), previous)
+
+
+def save_acl_vocabulary(filename: str, vocabulary: acl.AclVocabulary) -> None:
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=filename,
+        Body=json.dumps(vocabulary.to_dict()).encode("utf-8"),
+    )
+    logger.info(f"ACL vocabulary written to s3://{bucket_name}/{filename}")
+
+
 def add_extra_mapping_attributes(mappings: dict) -> dict:
+    # ACL attributes are only ever matched exactly, keyword (or integer codes)
+    # doc values filter much faster than analyzed text
     for attr in custom_attributes.split(","):
         mappings["properties"][attr] = {
-            "type": "text"
+            "type": acl.get_mapping_type()
         }
     return mappings
 
@@ -45,23 +88,161 @@ def create_os_client() -> OpenSearch:
     )
 
 
-def generate_embdeddings(
-    model_provider: str, model_id: str, doc_text: str
-) -> list[float]:
-    if model_provider == "bedrock":
-        bedrock_runtime = boto3.client("bedrock-runtime", region_name=region)
-        body = json.dumps({"inputText": doc_text, "dimensions": 1024})
-        response = bedrock_runtime.invoke_model(
-            body=body, modelId=model_id, accept="*/*", contentType="application/json"
-        )
-        response_body = json.loads(response.get("body").read())
+def vectors_in_source(os_client: OpenSearch, index_name: str) -> bool:
+    # Partial updates rebuild documents from _source, losing excluded vectors
+    mappings = os_client.indices.get_mapping(index=index_name)
+    for index_mappings in mappings.values():
+        excludes = index_mappings["mappings"].get("_source", {}).get("excludes", [])
+        if "doc_embedding" in excludes:
+            return False
+    return True
 
-        embedding = response_body.get("embedding")
 
-    else:
-        raise ValueError(f"Model provider {model_provider} is not supported.")
+def routing_required(os_client: OpenSearch, index_name: str) -> bool:
+    mappings = os_client.indices.get_mapping(index=index_name)
+    return any(
+        index_mappings["mappings"].get("_routing", {}).get("required", False)
+        for index_mappings in mappings.values()
+    )
+
+
+def bulk_action(operation: str, index_name: str, doc_id: str, routing: str = None) -> dict:
+    # Bulk action line, sent to the shard of the routing key when there is one
+    target = {"_index": index_name, "_id": doc_id}
+    if routing is not None:
+        target["routing"] = routing
+    return {operation: target}
+
+
+def delete_moved_documents(os_client: OpenSearch, index_name: str, moved: dict) -> set:
+    # Deletes the copies left on the shard of the previous routing key of
+    # documents whose key changed, given with their previous manifest entry.
+    # The new copy may be on the same shard under the same id: the _routing
+    # term leaves it out, and a copy overwritten since the query started is a
+    # version conflict that is skipped. Returns the documents whose old copies
+    # could not be deleted.
+    by_routing = {}
+    for doc_id, entry in moved.items():
+        by_routing.setdefault(entry["routing"], []).append(doc_id)
+    failed = set()
+    for routing, doc_ids in by_routing.items():
+        for start in range(0, len(doc_ids), MOVED_DELETE_BATCH):
+            batch = doc_ids[start : start + MOVED_DELETE_BATCH]
+            passage_ids = [
+                passage_id for doc_id in batch for passage_id in manifest.passage_ids(doc_id, moved[doc_id])
+            ]
+            try:
+                os_client.delete_by_query(
+                    index=index_name,
+                    routing=routing,
+                    conflicts="proceed",
+                    body={
+                        "query": {
+                            "bool": {
+                                "filter": [
+                                    {"ids": {"values": passage_ids}},
+                                    {"term": {"_routing": routing}},
+                                ]
+                            }
+                        }
+                    },
+                )
+            except Exception as e:
+                logger.error(f"Failed to delete moved documents from routing {routing}: {str(e)}")
+                failed.update(batch)
+    return failed
 
-    return embedding
+
+def plan_changes(
+    docs: Iterator[tuple[str, dict]],
+    previous: Manifest,
+    current: Manifest,
+    indexer: BulkIndexer,
+    index_name: str,
+    partial_updates: bool,
+    stats: dict,
+    parents: dict,
+    snapshot_writer: SnapshotWriter = None,
+) -> Iterator[tuple[str, dict]]:
+    # Yields only the documents that need a new embedding. Metadata-only changes
+    # are sent to the indexer as partial updates, unchanged documents skipped.
+    # Either way their vectors are copied to the snapshot being written.
+    # `parents` maps the id of every update sent to its document.
+    for doc_id, doc in docs:
+        hashes = {
+            "text": manifest.hash_text(doc["doc_text"]),
+            "metadata": manifest.hash_metadata(doc),
+        }
+        routing = acl.routing_key(doc)
+        known = None if previous.stale else previous.docs.get(doc_id)
+        if known and known.get("routing") != routing:
+            # A document cannot move to another shard in place, it is indexed
+            # again and its old copies deleted after the run
+            known = None
+        if known and known["text"] == hashes["text"]:
+            current.docs[doc_id] = {**known, **hashes}
+        else:
+            current.docs[doc_id] = hashes
+        if routing is not None:
+            current.docs[doc_id]["routing"] = routing
+
+        if known and known["text"] == hashes["text"] and known["metadata"] == hashes["metadata"]:
+            stats["unchanged"] += 1
+            if snapshot_writer is not None:
+                snapshot_writer.reuse(doc_id, known, doc)
+        elif known and known["text"] == hashes["text"] and partial_updates:
+            stats["metadata_updated"] += 1
+            if snapshot_writer is not None:
+                snapshot_writer.reuse(doc_id, known, doc)
+            metadata = {k: v for k, v in doc.items() if k != "doc_text"}
+            # A merge keeps fields it is not given, clear dropped ACL attributes
+            for attr in custom_attributes.split(","):
+                metadata.setdefault(attr, None)
+            for passage_id in manifest.passage_ids(doc_id, known):
+                parents[passage_id] = doc_id
+                indexer.add(
+                    bulk_action("update", index_name, passage_id, routing),
+                    {"doc": metadata},
+                )
+        else:
+            stats["embedded"] += 1
+            yield doc_id, doc
+
+
+def drop_failed_documents(
+    failed_ids: set, parents: dict, previous: Manifest, current: Manifest, moved: dict
+) -> set:
+    # Documents with a failed item are left out of the manifest (or kept, for
+    # failed deletes and moves) so the next run retries them. `parents` maps
+    # passage ids to their document. Returns the failed documents.
+    failed_docs = set()
+    for failed_id in failed_ids:
+        doc_id = parents.get(failed_id, failed_id)
+        failed_docs.add(doc_id)
+        if doc_id in current.docs and doc_id not in moved:
+            del current.docs[doc_id]
+        elif doc_id in previous.docs:
+            current.docs[doc_id] = previous.docs[doc_id]
+    return failed_docs
+
+
+def split_documents(
+    docs: Iterator[tuple[str, dict]],
+    current: Manifest,
+    chunking_options: dict,
+) -> Iterator[tuple[str, dict]]:
+    # One passage per yielded item, indexed as "<doc id>#<n>" with the parent
+    # doc id and all of the parent's metadata, ACL attributes included
+    for doc_id, doc in docs:
+        passages = chunking.split_passages(doc["doc_text"], **chunking_options)
+        current.docs[doc_id]["passages"] = len(passages)
+        for position, passage in enumerate(passages):
+            yield f"{doc_id}#{position}", {
+                **doc,
+                "doc_text": passage,
+                "parent_id": doc_id,
+                "passage_index": position,
+            }
 
 
 def bulk_data_upload_to_os(
@@ -70,68 +251,155 @@ def bulk_data_upload_to_os(
     index_name: str,
     model_id: str,
     model_provider: str,
-    os_client: boto3.client
-) -> list[dict]:
-    formatted_bulk_data = []
-    directory = f"/tmp/{data_file_name.split('.')[0]}/{directory}"
-    print(directory)
-    print(os.listdir("/tmp/")) 
-    for filename in os.listdir(directory):
-        if filename.endswith(".txt"):
-            doc = {}
-            # Construct the full file path
-            file_path = os.path.join(directory, filename)
-
-            # Open the file and read its contents
-            with open(file_path, "r") as file:
-                file_contents = file.read()
-
-            doc["doc_embedding"] = generate_embdeddings(
-                model_provider, model_id, file_contents
-            )
-            doc["doc_text"] = file_contents
-
-            # Read metadata from associated JSON file
-            json_filename = os.path.splitext(filename)[0] + '.json'
-            json_file_path = os.path.join(directory, json_filename)
-            if os.path.exists(json_file_path):
-                with open(json_file_path, 'r') as json_file:
-                    metadata = json.load(json_file)
-                    doc.update(metadata)
-            else:
-                logger.warning(f"No metadata file found for {filename}")
-
-            formatted_bulk_data.append(
-                {"index": {"_index": index_name, "_id": filename}}
-            )
-
-            formatted_bulk_data.append(doc)
-        if len(formatted_bulk_data) == 400: # bulk upload 400 documents at a time
-            os_client.bulk(body=formatted_bulk_data)
-            print("Successfully uploaded a bulk document")
-            formatted_bulk_data = []
-
-    os_client.bulk(body=formatted_bulk_data)
-
-
+    os_client: boto3.client,
+    vocabulary: acl.AclVocabulary,
+    embedding_concurrency: int = 8,
+    bulk_options: dict = None,
+    previous_manifest: Manifest = None,
+    embedding_store: EmbeddingStore = None,
+    chunking_options: dict = None,
+    snapshot_writer: SnapshotWriter = None,
+) -> tuple[dict, Manifest]:
+    # With a previous manifest only new and changed documents are (re)indexed
+    # and documents missing from the archive are deleted. With chunking options
+    # every document is indexed as passages. With a snapshot writer the run is
+    # also written as a snapshot. Returns the bulk summary and the manifest
+    # describing the index after this run.
+    prefix = f"{data_file_name.split('.')[0]}/{directory}"
+    print(prefix)
+
+    settings = manifest_settings(model_id, chunking_options)
+    previous = previous_manifest or Manifest(settings)
+    current = Manifest(settings)
+    stats = {"unchanged": 0, "metadata_updated": 0, "embedded": 0, "deleted": 0, "moved": 0}
+    parents = {}
+    moved = {}
+
+    data_archive = archive.open_archive(s3_client, bucket_name, data_file_name)
+    embedder = ParallelEmbedder(
+        model_provider,
+        model_id,
+        max_workers=embedding_concurrency,
+        dimensions=index_profile["dimension"],
+        store=embedding_store,
+    )
+    indexer = BulkIndexer(os_client, **(bulk_options or {}))
+    try:
+        changed = plan_changes(
+            archive.iter_documents(data_archive, prefix, vocabulary),
+            previous,
+            current,
+            indexer,
+            index_name,
+            partial_updates=bool(previous.docs) and vectors_in_source(os_client, index_name),
+            stats=stats,
+            parents=parents,
+            snapshot_writer=snapshot_writer,
+        )
+        if chunking_options is not None:
+            changed = split_documents(changed, current, chunking_options)
+        for doc_id, doc in embedder.embed_documents(changed):
+            parents[doc_id] = doc.get("parent_id", doc_id)
+            indexer.add(bulk_action("index", index_name, doc_id, acl.routing_key(doc)), doc)
+            if snapshot_writer is not None:
+                snapshot_writer.add(doc_id, doc)
+
+        # Remove documents missing from the archive, and passages left over
+        # from documents that were re-indexed into fewer (or no) passages.
+        # Documents that changed routing key are deleted once indexed again.
+        for doc_id, entry in previous.docs.items():
+            stale_ids = set(manifest.passage_ids(doc_id, entry))
+            if doc_id in current.docs:
+                if current.docs[doc_id].get("routing") != entry.get("routing"):
+                    stats["moved"] += 1
+                    moved[doc_id] = entry
+                    continue
+                stale_ids -= set(manifest.passage_ids(doc_id, current.docs[doc_id]))
+            for stale_id in stale_ids:
+                stats["deleted"] += 1
+                parents[stale_id] = doc_id
+                indexer.add(bulk_action("delete", index_name, stale_id, entry.get("routing")))
+    finally:
+        embedder.close()
+        embedder.report()
+        summary = indexer.close()
+        data_archive.close()
+
+    failed_docs = drop_failed_documents(indexer.failed_ids, parents, previous, current, moved)
+    # Moved documents are kept under their previous routing key until their
+    # old copies are gone, so that the next run moves them again
+    moved = {doc_id: entry for doc_id, entry in moved.items() if doc_id not in failed_docs}
+    for doc_id in delete_moved_documents(os_client, index_name, moved):
+        failed_docs.add(doc_id)
+        current.docs[doc_id] = previous.docs[doc_id]
+    if snapshot_writer is not None:
+        snapshot_writer.close(exclude_docs=failed_docs)
+
+    logger.info(f"Ingestion changes: {stats}")
+    summary["changes"] = stats
+    return summary, current
+
+
+def manifest_settings(model_id: str, chunking_options: dict) -> dict:
+    # Vectors made with other settings cannot be reused
+    return {
+        "model_id": model_id,
+        "dimension": index_profile["dimension"],
+        "chunking": chunking_options,
+    }
 
-def download_docs(file_name: str):
 
-    # Download the file from S3
-    local_file_path = "/tmp/" + file_name
-    s3_client.download_file(bucket_name, file_name, local_file_path)
+def create_snapshot_writer(
+    options: dict, previous_manifest: Manifest, model_id: str, chunking_options: dict
+) -> SnapshotWriter:
+    # Rows of unchanged documents are copied from the previous snapshot. When
+    # it is missing or does not hold them all, the manifest is marked stale so
+    # that every document is embedded again.
+    location = options.get("path", "/tmp/snapshot")
+    settings = manifest_settings(model_id, chunking_options)
+    dtype = options.get("dtype", "float16")
+    previous = None
+    if previous_manifest is not None and not previous_manifest.stale:
+        if "s3_prefix" in options:
+            found = snapshot.download(s3_client, bucket_name, options["s3_prefix"], location)
+        else:
+            found = os.path.exists(os.path.join(location, "header.json"))
+        if found:
+            try:
+                previous = Snapshot(location)
+            except ValueError as e:
+                logger.warning(f"Previous snapshot at {location} is unusable: {str(e)}")
+        if (
+            previous is None
+            or (previous.header["settings"], previous.dtype) != (settings, dtype)
+            or not previous.covers(previous_manifest)
+        ):
+            logger.info("No usable previous snapshot, embedding all documents again")
+            previous_manifest.stale = True
+            previous = None
+    return SnapshotWriter(
+        f"{location}.new",
+        index_profile["dimension"],
+        custom_attributes.split(","),
+        settings,
+        dtype=dtype,
+        space_type=index_profile["space_type"],
+        previous=previous,
+    )
 
-    # Unzip the downloaded file
-    with zipfile.ZipFile(local_file_path, "r") as zip_ref:
-        zip_ref.extractall("/tmp/")
 
-    print(f"File '{file_name}' downloaded and unzipped successfully.")
+def publish_snapshot(writer: SnapshotWriter, options: dict) -> None:
+    # The new snapshot replaces the previous one once it is complete
+    if "s3_prefix" in options:
+        snapshot.upload(s3_client, bucket_name, options["s3_prefix"], writer.directory)
+    location = writer.directory[: -len(".new")]
+    shutil.rmtree(location, ignore_errors=True)
+    os.rename(writer.directory, location)
 
 
 def handler(event, context):
     print(event)
     data_file_name = event["data_file_s3_path"]
-    download_docs(data_file_name)
 
     create_index = event.get("create_index", False)
     model_provider = event.get("model_provider", "bedrock")
@@ -143,6 +411,8 @@ def handler(event, context):
         mappings_file_s3_path = event.get("mappings_file_s3_path")
 
     index_name = event.get("index_name", "test-index")
+    incremental = event.get("incremental", False)
+    index_created = False
 
     # OpenSearch client initialization
     os_client = create_os_client()
@@ -157,14 +427,24 @@ def handler(event, context):
         # Creating index with settings and mappings
         mappings = load_json_from_s3(mappings_file_s3_path)
         mappings = add_extra_mapping_attributes(mappings)
+        if event.get("exclude_vectors_from_source", False):
+            # Smaller index and responses, but documents can no longer be
+            # reindexed or partially updated from _source without their vector
+            mappings["_source"] = {"excludes": ["doc_embedding"]}
+        if acl.routing_attribute:
+            # Writes without a routing key would land on the wrong shard
+            mappings["_routing"] = {"required": True}
         index_body = {
             "settings": load_json_from_s3(index_file_s3_path),
             "mappings": mappings,
         }
+        index_body = profiles.apply_profile(index_body, index_profile)
+        logger.info(f"Creating index {index_name} with profile {index_profile}")
 
         # Create index and mappings
         try:
             os_client.indices.create(index=index_name, body=index_body)
+            index_created = True
             logger.info(f"Index {index_name} created successfully.")
         except Exception as e:
             if "resource_already_exists_exception" in str(e):
@@ -178,23 +458,130 @@ def handler(event, context):
         logger.info("No index creation requested.")
 
     if load_data:
+        dimension = profiles.indexed_dimension(os_client, index_name)
+        if dimension != index_profile["dimension"]:
+            raise ValueError(
+                f"Index {index_name} holds {dimension} dimension vectors, profile "
+                f"{index_profile['name']} embeds {index_profile['dimension']}. Recreate the index."
+            )
+        if routing_required(os_client, index_name) != bool(acl.routing_attribute):
+            raise ValueError(
+                f"Index {index_name} does not match ROUTING_ATTRIBUTE={acl.routing_attribute!r}, "
+                "routing is set when an index is created. Recreate the index."
+            )
+        vocabulary_file_s3_path = event.get(
+            "vocabulary_file_s3_path", f"{index_name}-acl-vocabulary.json"
+        )
+        vocabulary = load_acl_vocabulary(vocabulary_file_s3_path)
+        manifest_path = event.get("manifest_path", f"{index_name}-manifest.json")
+        previous_manifest = None
+        if incremental and not index_created:
+            previous_manifest = Manifest.load(
+                s3_client,
+                bucket_name,
+                manifest_path,
+                manifest_settings(model_id, event.get("chunking")),
+            )
+
+        # Embeddings computed by earlier runs, keyed by model, dimension and text
+        store_options = event.get("embedding_store")
+        embedding_store = None
+        if store_options:
+            embedding_store = EmbeddingStore(
+                store_options.get("path", "/tmp/embedding-store"),
+                model_id,
+                index_profile["dimension"],
+                store_options.get("dtype", "float32"),
+            )
+            if "s3_prefix" in store_options:
+                embedding_store.download(
+                    s3_client, bucket_name, store_options["s3_prefix"]
+                )
+            embedding_store.load()
+
+        # Compact copy of the index for consumers other than OpenSearch, see snapshot.py
+        snapshot_options = event.get("snapshot")
+        snapshot_writer = None
+        if snapshot_options:
+            snapshot_writer = create_snapshot_writer(
+                snapshot_options, previous_manifest, model_id, event.get("chunking")
+            )
+
         # Perform bulk upload to OpenSearch
-        bulk_data_upload_to_os(
+        summary, current_manifest = bulk_data_upload_to_os(
             data_file_name=data_file_name,
             directory="data",
             index_name=index_name,
             model_id=model_id,
             model_provider=model_provider,
-            os_client=os_client
+            os_client=os_client,
+            vocabulary=vocabulary,
+            embedding_concurrency=event.get("embedding_concurrency", 8),
+            bulk_options=event.get("bulk_options"),
+            previous_manifest=previous_manifest,
+            embedding_store=embedding_store,
+            chunking_options=event.get("chunking"),
+            snapshot_writer=snapshot_writer,
         )
+        if summary["failed"]:
+            logger.error(
+                f"{summary['failed']} documents failed to index, first errors: {summary['errors']}"
+            )
+        vocabulary.passages = current_manifest.passage_count()
+        save_acl_vocabulary(vocabulary_file_s3_path, vocabulary)
+        current_manifest.save(s3_client, bucket_name, manifest_path)
+        if embedding_store is not None:
+            embedding_store.save()
+            if "s3_prefix" in store_options:
+                embedding_store.upload(
+                    s3_client, bucket_name, store_options["s3_prefix"]
+                )
+        if snapshot_writer is not None:
+            publish_snapshot(snapshot_writer, snapshot_options)
 
         # Query OpenSearch to verify bulk upload
-        query_body = {"query": {"match_all": {}}}
+        query_body = {
+            "_source": {"excludes": ["doc_embedding"]},
+            "query": {"match_all": {}},
+        }
         response = os_client.search(index=index_name, body=query_body)
         logger.info(
             f"Total records in index {index_name}: {response['hits']['total']['value']}"
         )
         logger.info(f"Partial response [:5]: {response['hits']['hits'][:5]}")
+
+        # Relevance threshold below which the search Lambda answers without the LLM
+        calibration_options = dict(event.get("calibrate_scores") or {})
+        if calibration_options:
+            # Held-out questions labelled with the id of the document answering them
+            if "questions_s3_path" in calibration_options:
+                calibration_options["questions"] = load_json_from_s3(
+                    calibration_options.pop("questions_s3_path")
+                )
+            os_client.indices.refresh(index=index_name)
+            embedder = ParallelEmbedder(
+                model_provider, model_id, max_workers=1, dimensions=index_profile["dimension"]
+            )
+            try:
+                scores = calibration.calibrate_scores(
+                    os_client, embedder, index_name, **calibration_options
+                )
+            finally:
+                embedder.close()
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=f"{index_name}-score-calibration.json",
+                Body=json.dumps(scores).encode("utf-8"),
+            )
+
+        # Signal the search Lambda that its cached answers and score threshold
+        # for this index are stale
+        boto3.client("ssm").put_parameter(
+            Name=f"IndexGeneration-{index_name}",
+            Value=str(int(time.time())),
+            Type="String",
+            Overwrite=True,
+        )
     else:
         logger.info("No data loading requested.")
 
@@ -0,0 +1,81 @@
+## Content-hash manifest for incremental ingestion
+import hashlib
+import json
+import logging
+import os
+
+import s3_objects
+
+logger = logging.getLogger()
+
+MANIFEST_VERSION = 2
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_metadata(doc: dict) -> str:
+    # Every field except the text and its vector, in a canonical form
+    metadata = {k: v for k, v in doc.items() if k not in ("doc_text", "doc_embedding")}
+    return hash_text(json.dumps(metadata, sort_keys=True))
+
+
+def passage_ids(doc_id: str, entry: dict) -> list[str]:
+    # Ids a document was indexed under: itself, or one per passage when chunked
+    if "passages" not in entry:
+        return [doc_id]
+    return [f"{doc_id}#{i}" for i in range(entry["passages"])]
+
+
+class Manifest:
+    """Text and metadata hashes of every document indexed by the last run.
+
+    `settings` (model id, chunking, ...) must match between runs for the
+    hashes to be trusted. A stale manifest still lists what is in the index
+    so that removed documents and passages can be deleted.
+    `location` is an absolute local path or a key in the data bucket.
+    """
+
+    def __init__(self, settings: dict, docs: dict = None, stale: bool = False):
+        self.settings = settings
+        self.docs = docs or {}
+        self.stale = stale
+
+    @classmethod
+    def load(cls, s3_client, bucket: str, location: str, settings: dict) -> "Manifest":
+        try:
+            if location.startswith("/"):
+                with open(location, "r") as file:
+                    data = json.load(file)
+            else:
+                file = s3_client.get_object(Bucket=bucket, Key=location)
+                data = json.loads(file["Body"].read().decode("utf-8"))
+        except Exception as e:
+            if not isinstance(e, FileNotFoundError) and not s3_objects.is_missing(e):
+                raise
+            logger.info(f"No manifest found at {location}, loading all documents")
+            return cls(settings)
+
+        if data.get("version") != MANIFEST_VERSION:
+            return cls(settings)
+        if data.get("settings") != settings:
+            # Vectors from another model or chunking cannot be reused
+            logger.info(f"Manifest at {location} is stale, loading all documents")
+            return cls(settings, data["docs"], stale=True)
+        return cls(settings, data["docs"])
+
+    def passage_count(self) -> int:
+        return sum(len(passage_ids(doc_id, entry)) for doc_id, entry in self.docs.items())
+
+    def save(self, s3_client, bucket: str, location: str) -> None:
+        body = json.dumps(
+            {"version": MANIFEST_VERSION, "settings": self.settings, "docs": self.docs}
+        )
+        if location.startswith("/"):
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            with open(location, "w") as file:
+                file.write(body)
+        else:
+            s3_client.put_object(Bucket=bucket, Key=location, Body=body.encode("utf-8"))
+        logger.info(f"Manifest with {len(self.docs)} documents written to {location}")
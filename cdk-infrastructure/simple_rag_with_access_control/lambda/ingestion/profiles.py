@@ -0,0 +1,61 @@
+## Index profiles: vector dimension, space type, HNSW parameters and encoder
+import json
+import os
+
+# The profile of indexes created before profiles existed
+DEFAULT_PROFILE = {
+    "name": "titan-1024-fp32",
+    "dimension": 1024,
+    "space_type": "l2",
+    "m": 16,
+    "ef_construction": 100,
+    "ef_search": 100,
+    "encoder": "flat",
+}
+ENCODERS = {
+    "flat": None,
+    # faiss scalar quantization to 16 bit floats, half the memory of the graph vectors
+    "sq_fp16": {"name": "sq", "parameters": {"type": "fp16"}},
+}
+
+
+def load_profile() -> dict:
+    # Resolved by the stack from index_profiles.json and given to the search
+    # Lambda too, so that both embed with the same dimension
+    profile = os.environ.get("INDEX_PROFILE")
+    return json.loads(profile) if profile else DEFAULT_PROFILE
+
+
+def knn_field_mapping(profile: dict) -> dict:
+    # The faiss engine reads its search-time ef from the method parameters,
+    # the index.knn.algo_param.ef_search setting only applies to nmslib
+    parameters = {
+        "m": profile["m"],
+        "ef_construction": profile["ef_construction"],
+        "ef_search": profile["ef_search"],
+    }
+    encoder = ENCODERS[profile["encoder"]]
+    if encoder is not None:
+        parameters["encoder"] = encoder
+    return {
+        "type": "knn_vector",
+        "dimension": profile["dimension"],
+        "method": {
+            "name": "hnsw",
+            "space_type": profile["space_type"],
+            "engine": "faiss",
+            "parameters": parameters,
+        },
+    }
+
+
+def apply_profile(index_body: dict, profile: dict) -> dict:
+    # Overrides the vector field of mappings.json
+    index_body["mappings"]["properties"]["doc_embedding"] = knn_field_mapping(profile)
+    return index_body
+
+
+def indexed_dimension(os_client, index_name: str) -> int:
+    mappings = os_client.indices.get_mapping(index=index_name)
+    for index_mappings in mappings.values():
+        return index_mappings["mappings"]["properties"]["doc_embedding"]["dimension"]
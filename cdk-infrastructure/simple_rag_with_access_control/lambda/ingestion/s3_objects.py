@@ -0,0 +1,11 @@
+## Missing S3 objects
+from botocore.exceptions import ClientError
+
+# The Lambda roles hold s3:ListBucket, so S3 reports a missing key as such
+# (NoSuchKey from GetObject, 404 from the HeadObject of download_file)
+# instead of a 403 that could not be told apart from a denied read
+MISSING_KEY_CODES = ("NoSuchKey", "404")
+
+
+def is_missing(error: Exception) -> bool:
+    return isinstance(error, ClientError) and error.response["Error"]["Code"] in MISSING_KEY_CODES
@@ -0,0 +1,223 @@
+## Compact index snapshot, for consumers that should not scroll OpenSearch
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+import manifest
+import s3_objects
+
+logger = logging.getLogger()
+
+SNAPSHOT_VERSION = 1
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def quantize(vector: np.ndarray) -> tuple[np.ndarray, float]:
+    # Symmetric int8 with one scale per row
+    scale = float(np.abs(vector).max()) / 127 or 1.0
+    return np.clip(np.rint(vector / scale), -127, 127).astype(np.int8), scale
+
+
+class Snapshot:
+    """Index snapshot loaded from a directory, vectors memory-mapped as stored.
+
+    header.json holds the version, row count, dimension, vector dtype, space
+    type, the settings the vectors were made with and the sha256 of every
+    other file. vectors.bin is the row major matrix, float32, float16 or
+    int8 with the float32 scale of each row in scales.bin. docs.json holds
+    the ids, texts, parent ids and passage indexes by row, acl.json the
+    values of each ACL attribute and the value codes of every row.
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "header.json"), "r") as file:
+            self.header = json.load(file)
+        if self.header["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot version {self.header['version']} is not supported")
+        for name, checksum in self.header["checksums"].items():
+            if file_digest(os.path.join(directory, name)) != checksum:
+                raise ValueError(f"Snapshot file {name} does not match its checksum")
+        self.count = self.header["count"]
+        self.dtype = self.header["dtype"]
+        self.vectors = self.scales = None
+        if self.count:
+            self.vectors = np.memmap(
+                os.path.join(directory, "vectors.bin"),
+                dtype=DTYPES[self.dtype],
+                mode="r",
+                shape=(self.count, self.header["dimension"]),
+            )
+            if self.dtype == "int8":
+                self.scales = np.memmap(
+                    os.path.join(directory, "scales.bin"), dtype=np.float32, mode="r"
+                )
+        with open(os.path.join(directory, "docs.json"), "r") as file:
+            self.docs = json.load(file)
+        with open(os.path.join(directory, "acl.json"), "r") as file:
+            self.acl = json.load(file)
+        self.rows = {doc_id: row for row, doc_id in enumerate(self.docs["ids"])}
+
+    def dequantize(self, rows) -> np.ndarray:
+        # float32 copies of the given rows, the mapped matrix is never copied whole
+        vectors = self.vectors[rows].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][..., None]
+        return vectors
+
+    def covers(self, previous: manifest.Manifest) -> bool:
+        # Whether every document of the previous run can be copied from here
+        return all(
+            passage_id in self.rows
+            for doc_id, entry in previous.docs.items()
+            for passage_id in manifest.passage_ids(doc_id, entry)
+        )
+
+
+class SnapshotWriter:
+    """Writes the documents of an ingestion run as a Snapshot.
+
+    Vectors are appended to vectors.bin as they arrive. Rows of documents
+    that did not change are copied from the previous snapshot, with the ACL
+    values of the current run.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        dimension: int,
+        attributes: list[str],
+        settings: dict,
+        dtype: str = "float16",
+        space_type: str = "l2",
+        previous: Snapshot = None,
+    ):
+        if dtype not in DTYPES:
+            raise ValueError(f"Snapshot dtype {dtype} is not supported")
+        self.directory = directory
+        self.dimension = dimension
+        self.attributes = attributes
+        self.settings = settings
+        self.dtype = dtype
+        self.space_type = space_type
+        self.previous = previous
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_file = open(os.path.join(directory, "vectors.bin"), "wb")
+        self.scales = []
+        self.docs = {"ids": [], "texts": [], "parent_ids": [], "passage_indexes": []}
+        self.acl = {attr: ({}, []) for attr in attributes}
+
+    def _add_row(self, doc_id: str, text: str, parent_id, passage_index, metadata: dict) -> None:
+        self.docs["ids"].append(doc_id)
+        self.docs["texts"].append(text)
+        self.docs["parent_ids"].append(parent_id)
+        self.docs["passage_indexes"].append(passage_index)
+        for attr, (values, rows) in self.acl.items():
+            rows.append([values.setdefault(value, len(values)) for value in metadata.get(attr) or []])
+
+    def add(self, doc_id: str, doc: dict) -> None:
+        # A document (or passage) as sent to OpenSearch, embedding included
+        vector = np.asarray(doc["doc_embedding"], dtype=np.float32)
+        if self.dtype == "int8":
+            vector, scale = quantize(vector)
+            self.scales.append(scale)
+        self.vectors_file.write(vector.astype(DTYPES[self.dtype]).tobytes())
+        self._add_row(doc_id, doc["doc_text"], doc.get("parent_id"), doc.get("passage_index"), doc)
+
+    def reuse(self, doc_id: str, entry: dict, doc: dict) -> None:
+        # Copies the rows of an unchanged document, `doc` gives its current metadata
+        for passage_id in manifest.passage_ids(doc_id, entry):
+            row = self.previous.rows[passage_id]
+            self.vectors_file.write(self.previous.vectors[row].tobytes())
+            if self.dtype == "int8":
+                self.scales.append(float(self.previous.scales[row]))
+            self._add_row(
+                passage_id,
+                self.previous.docs["texts"][row],
+                self.previous.docs["parent_ids"][row],
+                self.previous.docs["passage_indexes"][row],
+                doc,
+            )
+
+    def close(self, exclude_docs: set = frozenset()) -> dict:
+        # Drops the rows of documents OpenSearch rejected, given by document or
+        # passage id, so that the snapshot matches the index. The header is
+        # written last.
+        self.vectors_file.close()
+        count = len(self.docs["ids"])
+        keep = [
+            row
+            for row, doc_id in enumerate(self.docs["ids"])
+            if doc_id not in exclude_docs and self.docs["parent_ids"][row] not in exclude_docs
+        ]
+        if len(keep) < count:
+            vectors_path = os.path.join(self.directory, "vectors.bin")
+            vectors = np.fromfile(vectors_path, dtype=DTYPES[self.dtype])
+            vectors.reshape(count, self.dimension)[keep].tofile(vectors_path)
+            self.scales = [self.scales[row] for row in keep] if self.scales else []
+            self.docs = {key: [values[row] for row in keep] for key, values in self.docs.items()}
+            self.acl = {
+                attr: (values, [rows[row] for row in keep]) for attr, (values, rows) in self.acl.items()
+            }
+
+        files = {"vectors.bin": None, "docs.json": self.docs}
+        files["acl.json"] = {
+            attr: {"values": list(values), "rows": rows} for attr, (values, rows) in self.acl.items()
+        }
+        if self.dtype == "int8":
+            np.asarray(self.scales, dtype=np.float32).tofile(os.path.join(self.directory, "scales.bin"))
+            files["scales.bin"] = None
+        for name, content in files.items():
+            if content is not None:
+                with open(os.path.join(self.directory, name), "w") as file:
+                    json.dump(content, file)
+
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "count": len(keep),
+            "dimension": self.dimension,
+            "dtype": self.dtype,
+            "space_type": self.space_type,
+            "settings": self.settings,
+            "checksums": {name: file_digest(os.path.join(self.directory, name)) for name in files},
+        }
+        with open(os.path.join(self.directory, "header.json"), "w") as file:
+            json.dump(header, file)
+        logger.info(f"Snapshot of {len(keep)} rows written to {self.directory}")
+        return header
+
+
+def download(s3_client, bucket: str, prefix: str, directory: str) -> bool:
+    # False when there is no snapshot under the prefix
+    os.makedirs(directory, exist_ok=True)
+    header_path = os.path.join(directory, "header.json")
+    try:
+        s3_client.download_file(bucket, f"{prefix}header.json", header_path)
+    except Exception as e:
+        if s3_objects.is_missing(e):
+            return False
+        raise
+    with open(header_path, "r") as file:
+        header = json.load(file)
+    for name in header["checksums"]:
+        s3_client.download_file(bucket, f"{prefix}{name}", os.path.join(directory, name))
+    return True
+
+
+def upload(s3_client, bucket: str, prefix: str, directory: str) -> None:
+    # The header goes last, readers verify the other files against it
+    with open(os.path.join(directory, "header.json"), "r") as file:
+        header = json.load(file)
+    for name in list(header["checksums"]) + ["header.json"]:
+        s3_client.upload_file(os.path.join(directory, name), bucket, f"{prefix}{name}")
+    logger.info(f"Snapshot uploaded to s3://{bucket}/{prefix}")
@@ -0,0 +1,181 @@
+## Content-addressed embedding store shared across ingestion runs
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+import s3_objects
+
+logger = logging.getLogger()
+
+FILES = ("header.json", "keys.bin", "vectors.bin")
+DIGEST_SIZE = 32
+# New rows held in memory before they are appended to the data files
+FLUSH_ROWS = 1024
+
+
+def text_digest(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingStore:
+    """Append-only store of embeddings keyed by sha256 of the embedded text.
+
+    One store holds a single (model id, dimension) pair, under its own
+    directory. vectors.bin is a contiguous row-major float32/float16 matrix
+    that is memory-mapped, keys.bin the 32-byte digest of each row in the
+    same order, and header.json describes both. New rows are appended to the
+    data files in blocks of FLUSH_ROWS as they arrive.
+    """
+
+    def __init__(self, root: str, model_id: str, dimension: int, dtype: str = "float32"):
+        self.model_id = model_id
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        safe_model_id = model_id.replace(":", "_").replace("/", "_")
+        self.directory = os.path.join(root, f"{safe_model_id}-{dimension}-{self.dtype.name}")
+        self.rows = {}
+        # Rows counted by the header, and rows appended to the data files since
+        self.saved_count = 0
+        self.written_count = 0
+        self.vectors = None
+        self.files = None
+        self.pending_keys = []
+        self.pending_vectors = []
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        header_path = os.path.join(self.directory, "header.json")
+        if not os.path.exists(header_path):
+            logger.info(f"No embedding store at {self.directory}, starting empty")
+            return
+        with open(header_path, "r") as file:
+            header = json.load(file)
+        if (header["model_id"], header["dimension"], header["dtype"]) != (
+            self.model_id,
+            self.dimension,
+            self.dtype.name,
+        ):
+            raise ValueError(f"Embedding store at {self.directory} does not match {header}")
+
+        count = header["count"]
+        keys = np.fromfile(os.path.join(self.directory, "keys.bin"), dtype=np.uint8)
+        keys = keys[: count * DIGEST_SIZE].reshape(count, DIGEST_SIZE)
+        self.rows = {key.tobytes(): row for row, key in enumerate(keys)}
+        self.saved_count = count
+        self.written_count = count
+        self._map_vectors()
+        logger.info(f"Embedding store at {self.directory} loaded with {count} vectors")
+
+    def _map_vectors(self) -> None:
+        self.vectors = None
+        if self.written_count:
+            self.vectors = np.memmap(
+                os.path.join(self.directory, "vectors.bin"),
+                dtype=self.dtype,
+                mode="r",
+                shape=(self.written_count, self.dimension),
+            )
+
+    def get(self, digest: bytes) -> list[float]:
+        with self.lock:
+            row = self.rows.get(digest)
+            if row is None:
+                return None
+            self.hits += 1
+            if row >= self.written_count:
+                return self.pending_vectors[row - self.written_count]
+            vectors = self.vectors
+        return vectors[row].astype(np.float32).tolist()
+
+    def put(self, digest: bytes, vector: list[float]) -> None:
+        with self.lock:
+            if digest in self.rows:
+                return
+            self.rows[digest] = len(self.rows)
+            self.pending_keys.append(digest)
+            self.pending_vectors.append(vector)
+            if len(self.pending_keys) >= FLUSH_ROWS:
+                self._flush()
+
+    def _flush(self) -> None:
+        # Appends the pending rows to the data files. The header still counts
+        # the saved rows only, until save() rewrites it.
+        if not self.pending_keys:
+            return
+        if self.files is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.files = {}
+            for name, size in (
+                ("vectors.bin", self.saved_count * self.dimension * self.dtype.itemsize),
+                ("keys.bin", self.saved_count * DIGEST_SIZE),
+            ):
+                file = open(os.path.join(self.directory, name), "ab")
+                # Drop any tail left by an interrupted run before appending
+                file.truncate(size)
+                self.files[name] = file
+        self.files["vectors.bin"].write(np.asarray(self.pending_vectors, dtype=self.dtype).tobytes())
+        self.files["keys.bin"].write(b"".join(self.pending_keys))
+        for file in self.files.values():
+            file.flush()
+        self.written_count += len(self.pending_keys)
+        self.pending_keys = []
+        self.pending_vectors = []
+        self._map_vectors()
+
+    def save(self) -> None:
+        # Appends the remaining rows, then rewrites the header, so an interrupted
+        # save leaves a store that is still readable up to its previous count
+        with self.lock:
+            self._flush()
+            if self.files is None:
+                return
+            for file in self.files.values():
+                file.close()
+            self.files = None
+            with open(os.path.join(self.directory, "header.json"), "w") as file:
+                json.dump(
+                    {
+                        "model_id": self.model_id,
+                        "dimension": self.dimension,
+                        "dtype": self.dtype.name,
+                        "count": self.written_count,
+                    },
+                    file,
+                )
+            logger.info(
+                f"Embedding store at {self.directory} saved with {self.written_count - self.saved_count} new vectors"
+            )
+            self.saved_count = self.written_count
+
+    def download(self, s3_client, bucket: str, prefix: str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        for name in FILES:
+            key = f"{prefix}{os.path.basename(self.directory)}/{name}"
+            try:
+                s3_client.download_file(bucket, key, os.path.join(self.directory, name))
+            except ClientError as e:
+                if s3_objects.is_missing(e):
+                    logger.info(f"No embedding store file s3://{bucket}/{key}")
+                elif e.response["Error"]["Code"] in ("403", "AccessDenied"):
+                    # The store is only a cache, the run embeds what it cannot read
+                    logger.warning(f"Embedding store file s3://{bucket}/{key} is not readable, starting empty")
+                else:
+                    raise
+                # Without all of its files the store starts empty
+                for downloaded in FILES[: FILES.index(name)]:
+                    os.remove(os.path.join(self.directory, downloaded))
+                return
+
+    def upload(self, s3_client, bucket: str, prefix: str) -> None:
+        # Header last: readers never see a header counting rows not uploaded yet
+        for name in ("vectors.bin", "keys.bin", "header.json"):
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                key = f"{prefix}{os.path.basename(self.directory)}/{name}"
+                s3_client.upload_file(path, bucket, key)
@@ -0,0 +1,67 @@
+## Local verification of Cognito ID tokens
+import logging
+import os
+import threading
+
+import jwt
+
+logger = logging.getLogger()
+region = os.environ["AWS_REGION"]
+user_pool_id = os.environ.get("USER_POOL_ID", "")
+user_pool_client_id = os.environ.get("USER_POOL_CLIENT_ID", "")
+
+# Seconds the downloaded key set is trusted before it is fetched again. Unknown
+# key ids (key rotation) always trigger a refetch.
+JWKS_REFRESH_SECONDS = int(os.environ.get("JWKS_REFRESH_SECONDS", "3600"))
+
+_lock = threading.Lock()
+_jwks_client = None
+
+
+def get_issuer() -> str:
+    return f"https://cognito-idp.{region}.amazonaws.com/{user_pool_id}"
+
+
+def get_jwks_client() -> jwt.PyJWKClient:
+    global _jwks_client
+    with _lock:
+        if _jwks_client is None:
+            _jwks_client = jwt.PyJWKClient(
+                f"{get_issuer()}/.well-known/jwks.json",
+                cache_jwk_set=True,
+                lifespan=JWKS_REFRESH_SECONDS,
+            )
+        return _jwks_client
+
+
+def verify_id_token(id_token: str, jwks_client: jwt.PyJWKClient = None) -> dict:
+    # Checks signature, expiry, issuer, audience and token use, and returns the claims
+    if id_token.startswith("Bearer "):
+        id_token = id_token[len("Bearer "):]
+    jwks_client = jwks_client or get_jwks_client()
+    signing_key = jwks_client.get_signing_key_from_jwt(id_token)
+    claims = jwt.decode(
+        id_token,
+        signing_key.key,
+        algorithms=["RS256"],
+        audience=user_pool_client_id,
+        issuer=get_issuer(),
+        options={"require": ["exp", "iat", "iss", "aud", "token_use"]},
+    )
+    if claims["token_use"] != "id":
+        raise jwt.InvalidTokenError(f"Expected an ID token, got {claims['token_use']}")
+    return claims
+
+
+def get_user_attributes_from_claims(
+    claims: dict, custom_attr_list: list[str]
+) -> dict[str, list]:
+    # Returns None when any attribute is missing from the claims, so the caller
+    # can fall back to Cognito GetUser
+    user_attr = {}
+    for attr_name in custom_attr_list:
+        value = claims.get(f"custom:{attr_name}")
+        if value is None:
+            return None
+        user_attr[attr_name] = [item.strip() for item in value.split(",")]
+    return user_attr
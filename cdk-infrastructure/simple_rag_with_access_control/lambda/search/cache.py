@@ -0,0 +1,320 @@
+## In-process and shared caches for the search pipeline
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger()
+
+
+class LRUCache:
+    """Thread safe LRU cache bounded by entry count and bytes, with a TTL."""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float, on_remove=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # Called with the key of every entry evicted, expired or invalidated,
+        # under the cache lock: it must not call back into the cache
+        self.on_remove = on_remove
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: str, value, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key: str = None) -> None:
+        with self._lock:
+            if key is None:
+                for removed in list(self._entries):
+                    self._remove(removed)
+            elif key in self._entries:
+                self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+
+class FileCacheTier:
+    """Shared tier on a directory, e.g. an EFS mount used by several containers."""
+
+    def __init__(self, directory: str, ttl_seconds: float):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key: str) -> bytes:
+        path = os.path.join(self.directory, key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+            with open(path, "rb") as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        # Write then rename so readers never see a partial entry
+        path = os.path.join(self.directory, key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(value)
+        os.replace(tmp_path, path)
+
+
+class RedisCacheTier:
+    """Shared tier on any Redis compatible endpoint (requires the redis package)."""
+
+    def __init__(self, url: str, ttl_seconds: float, prefix: str):
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2)
+        self.ttl_seconds = int(ttl_seconds)
+        self.prefix = prefix
+
+    def get(self, key: str) -> bytes:
+        return self.client.get(self.prefix + key)
+
+    def put(self, key: str, value: bytes) -> None:
+        self.client.set(self.prefix + key, value, ex=self.ttl_seconds)
+
+
+def create_shared_tier(url: str, ttl_seconds: float, prefix: str):
+    # file:///mnt/cache/embeddings or redis://host:6379/0, empty to disable
+    if not url:
+        return None
+    if url.startswith("file://"):
+        return FileCacheTier(url[len("file://"):], ttl_seconds)
+    if url.startswith(("redis://", "rediss://")):
+        return RedisCacheTier(url, ttl_seconds, prefix)
+    raise ValueError(f"Unsupported cache url {url}")
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+class EmbeddingCache:
+    """Query embeddings keyed by normalized text, model id and dimension."""
+
+    def __init__(self, local: LRUCache, shared=None):
+        self.local = local
+        self.shared = shared
+        self.shared_hits = 0
+
+    @staticmethod
+    def make_key(text: str, model_id: str, dimensions: int) -> str:
+        raw = f"{model_id}|{dimensions}|{normalize_text(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> list[float]:
+        embedding = self._get_local(key)
+        if embedding is not None or self.shared is None:
+            return embedding
+        try:
+            value = self.shared.get(key)
+        except Exception as e:
+            logger.warning(f"Shared embedding cache read failed: {str(e)}")
+            return None
+        if value is None:
+            return None
+        self.shared_hits += 1
+        embedding = array("d", value).tolist()
+        self._put_local(key, embedding)
+        return embedding
+
+    def put(self, key: str, embedding: list[float]) -> None:
+        self._put_local(key, embedding)
+        if self.shared is not None:
+            try:
+                self.shared.put(key, array("d", embedding).tobytes())
+            except Exception as e:
+                logger.warning(f"Shared embedding cache write failed: {str(e)}")
+
+    def stats(self) -> dict:
+        return {**self.local.stats(), "shared_hits": self.shared_hits}
+
+    def _get_local(self, key: str) -> list[float]:
+        packed = self.local.get(key)
+        return None if packed is None else packed.tolist()
+
+    def _put_local(self, key: str, embedding: list[float]) -> None:
+        # Packed float32, a quarter of the memory of a list of Python floats
+        packed = array("f", embedding)
+        self.local.put(key, packed, sys.getsizeof(packed))
+
+
+def entitlement_signature(user_attributes: dict[str, list]) -> str:
+    # Canonical hash of the attribute dict: same entitlements, same signature,
+    # whatever the order of attributes and values
+    canonical = json.dumps(
+        {attr: sorted(set(values)) for attr, values in user_attributes.items()},
+        sort_keys=True,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _unit_vector(vector: list[float]) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+class VectorGroup:
+    """Unit vectors of the questions cached for one signature, one row each."""
+
+    def __init__(self, dimension: int):
+        self.keys = []
+        self.rows = {}
+        self.vectors = np.empty((16, dimension), dtype=np.float32)
+
+    def put(self, key: str, unit_vector: np.ndarray) -> None:
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.keys)
+            if row == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+            self.rows[key] = row
+            self.keys.append(key)
+        self.vectors[row] = unit_vector
+
+    def remove(self, key: str) -> None:
+        # The last row takes the place of the removed one
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        last_key = self.keys.pop()
+        if row < len(self.keys):
+            self.keys[row] = last_key
+            self.rows[last_key] = row
+            self.vectors[row] = self.vectors[len(self.keys)]
+
+    def search(self, unit_query: np.ndarray, threshold: float) -> list[str]:
+        # Keys of the questions at least as similar as the threshold, best first
+        scores = self.vectors[: len(self.keys)] @ unit_query
+        matches = np.flatnonzero(scores >= threshold)
+        return [self.keys[row] for row in matches[np.argsort(-scores[matches])]]
+
+
+class AnswerCache:
+    """Generated answers partitioned by entitlement signature.
+
+    An entry is only ever looked up with the signature it was stored under, so
+    an answer is never served to a user holding a different set of attributes.
+    The question vectors of each signature are kept in their own matrix, so a
+    semantic lookup only scores the entries of the user's signature.
+    """
+
+    def __init__(self, local: LRUCache, similarity_threshold: float = 0.0):
+        self.local = local
+        self.local.on_remove = self._unindex
+        # Cosine similarity above which a different question counts as the same,
+        # 0 to match exact (normalized) questions only
+        self.similarity_threshold = similarity_threshold
+        self.semantic_hits = 0
+        self.groups = {}  # signature -> VectorGroup
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(question: str, signature: str) -> str:
+        digest = hashlib.sha256(normalize_text(question).encode("utf-8")).hexdigest()
+        return f"{signature}:{digest}"
+
+    def get(self, question: str, signature: str, query_vector: list[float] = None):
+        answer = self.local.get(self.make_key(question, signature))
+        if answer is not None or not self.similarity_threshold or query_vector is None:
+            return answer
+
+        unit_query = _unit_vector(query_vector)
+        with self.lock:
+            group = self.groups.get(signature)
+            if group is None or group.vectors.shape[1] != len(unit_query):
+                return None
+            keys = group.search(unit_query, self.similarity_threshold)
+        for key in keys:
+            answer = self.local.get(key)
+            if answer is not None:
+                self.semantic_hits += 1
+                return answer
+            # Evicted while its row was being added
+            self._unindex(key)
+        return None
+
+    def put(
+        self,
+        question: str,
+        signature: str,
+        query_vector: list[float],
+        answer: str,
+    ) -> None:
+        key = self.make_key(question, signature)
+        if not self.similarity_threshold or not query_vector:
+            self.local.put(key, answer, sys.getsizeof(answer))
+            return
+        unit_vector = _unit_vector(query_vector)
+        self.local.put(key, answer, sys.getsizeof(answer) + unit_vector.nbytes)
+        with self.lock:
+            group = self.groups.get(signature)
+            if group is None:
+                group = self.groups[signature] = VectorGroup(len(unit_vector))
+            if group.vectors.shape[1] == len(unit_vector):
+                group.put(key, unit_vector)
+
+    def _unindex(self, key: str) -> None:
+        signature = key.split(":", 1)[0]
+        with self.lock:
+            group = self.groups.get(signature)
+            if group is not None:
+                group.remove(key)
+                if not group.keys:
+                    del self.groups[signature]
+
+    def invalidate(self) -> None:
+        self.local.invalidate()
+
+    def stats(self) -> dict:
+        return {**self.local.stats(), "semantic_hits": self.semantic_hits}
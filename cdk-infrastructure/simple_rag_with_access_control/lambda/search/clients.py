@@ -0,0 +1,111 @@
+## Warm-container client registry
+import logging
+import os
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from opensearchpy import AWSV4SignerAuth, OpenSearch, RequestsHttpConnection
+
+logger = logging.getLogger()
+region = os.environ["AWS_REGION"]
+domain_endpoint = os.environ["AOS_ENDPOINT"]
+
+# Seconds a health check result is trusted before OpenSearch is probed again
+HEALTH_CHECK_TTL = int(os.environ.get("AOS_HEALTH_CHECK_TTL", "30"))
+POOL_MAXSIZE = 20
+
+session = boto3.Session()
+_lock = threading.Lock()
+_clients = {}
+_os_client = None
+_os_auth = None
+_os_unhealthy = False
+_os_last_health_check = 0.0
+
+
+def get_client(service_name: str, endpoint_url: str = None):
+    # boto3 clients are thread safe and keep their own connection pool, so one
+    # client per service is shared by every invocation served by this container
+    key = (service_name, endpoint_url)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = session.client(
+                    service_name,
+                    endpoint_url=endpoint_url,
+                    config=Config(
+                        max_pool_connections=POOL_MAXSIZE, tcp_keepalive=True
+                    ),
+                )
+                _clients[key] = client
+    return client
+
+
+def _refresh_session() -> None:
+    # Static credentials are resolved once per boto3 session. A new session picks
+    # up rotated credentials; refreshable credentials rotate on their own.
+    global session
+    session = boto3.Session()
+    _clients.clear()
+    if _os_auth is not None:
+        _os_auth.signer.credentials = session.get_credentials()
+    logger.warning("AWS session refreshed, clients will be re-created and re-signed.")
+
+
+def _create_opensearch_client() -> OpenSearch:
+    global _os_auth
+    _os_auth = AWSV4SignerAuth(session.get_credentials(), region, "es")
+    return OpenSearch(
+        hosts=[{"host": domain_endpoint, "port": 443}],
+        http_auth=_os_auth,
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection,
+        pool_maxsize=POOL_MAXSIZE,
+    )
+
+
+def _health_check(os_client: OpenSearch) -> bool:
+    global _os_unhealthy, _os_last_health_check
+    _os_last_health_check = time.monotonic()
+    try:
+        response = os_client.info()
+        logger.info(
+            f"Connection to OpenSearch successful. Cluster name: {response['cluster_name']}"
+        )
+        _os_unhealthy = False
+        return True
+    except Exception as e:
+        logger.error(
+            f"Connection to OpenSearch failed {domain_endpoint}. Detailed error: {str(e)}"
+        )
+        return False
+
+
+def get_opensearch_client() -> OpenSearch:
+    global _os_client
+    with _lock:
+        if _os_client is None:
+            _os_client = _create_opensearch_client()
+        if (
+            _os_unhealthy
+            and time.monotonic() - _os_last_health_check > HEALTH_CHECK_TTL
+            and not _health_check(_os_client)
+        ):
+            # Drop the pooled connections so the next request starts clean
+            _os_client = _create_opensearch_client()
+        return _os_client
+
+
+def report_opensearch_failure(error: Exception) -> None:
+    # Called by the search path when a request fails. The next caller runs a
+    # health check (at most once per HEALTH_CHECK_TTL) instead of every request.
+    global _os_unhealthy
+    with _lock:
+        _os_unhealthy = True
+        if getattr(error, "status_code", None) in (401, 403):
+            _refresh_session()
@@ -0,0 +1,87 @@
+## Token-budgeted context packing for the generation prompt
+import re
+
+WORD = re.compile(r"\w+")
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+# Documents sharing more word shingles than this with an already packed one are skipped
+NEAR_DUPLICATE_SIMILARITY = 0.8
+SHINGLE_SIZE = 5
+# A truncated document shorter than this is not worth its markup
+MIN_DOC_TOKENS = 40
+
+
+def estimate_tokens(text: str) -> int:
+    # About four characters per token for English text with both Claude and Llama
+    return max(1, (len(text) + 3) // 4)
+
+
+def _shingles(text: str) -> set:
+    words = WORD.findall(text.lower())
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))}
+
+
+def _is_near_duplicate(shingles: set, packed: list[set]) -> bool:
+    for other in packed:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union > NEAR_DUPLICATE_SIMILARITY:
+            return True
+    return False
+
+
+def most_relevant_span(text: str, question: str, max_tokens: int) -> str:
+    # Contiguous run of sentences within max_tokens that holds the most
+    # occurrences of the question's words
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    terms = {word for word in WORD.findall(question.lower()) if len(word) > 2}
+    sentences = [s for s in SENTENCE_BOUNDARY.split(text) if s.strip()]
+    scores = [sum(word in terms for word in WORD.findall(s.lower())) for s in sentences]
+    tokens = [estimate_tokens(s) + 1 for s in sentences]
+
+    best_start, best_end, best_score = 0, 0, -1
+    start, window_tokens, window_score = 0, 0, 0
+    for end in range(len(sentences)):
+        window_tokens += tokens[end]
+        window_score += scores[end]
+        while window_tokens > max_tokens and start <= end:
+            window_tokens -= tokens[start]
+            window_score -= scores[start]
+            start += 1
+        if start <= end and window_score > best_score:
+            best_start, best_end, best_score = start, end + 1, window_score
+
+    if best_end == 0:
+        # A single sentence longer than the budget
+        return text[: max_tokens * 4]
+    return " ".join(sentences[best_start:best_end])
+
+
+def build_context(
+    question: str, docs: list[dict], token_budget: int, max_doc_tokens: int = None
+) -> tuple[str, int]:
+    # Packs the best scoring documents, without near duplicates, each cut to
+    # its most relevant span of at most max_doc_tokens (half the budget by
+    # default), until token_budget is used. Returns the context and the number
+    # of tokens it holds.
+    max_doc_tokens = max_doc_tokens or token_budget // 2
+    parts = []
+    packed = []
+    used = 0
+    for doc in sorted(docs, key=lambda d: d["score"], reverse=True):
+        remaining = token_budget - used
+        if remaining < MIN_DOC_TOKENS:
+            break
+        shingles = _shingles(doc["doc_content"])
+        if _is_near_duplicate(shingles, packed):
+            continue
+        header = f'<document source="{doc["doc_name"]}">\n'
+        footer = "\n</document>\n"
+        overhead = estimate_tokens(header + footer)
+        text = most_relevant_span(
+            doc["doc_content"], question, min(remaining, max_doc_tokens) - overhead
+        )
+        part = f"{header}{text}{footer}"
+        packed.append(shingles)
+        parts.append(part)
+        used += estimate_tokens(part)
+    return "".join(parts), used
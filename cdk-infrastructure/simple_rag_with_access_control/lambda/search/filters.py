@@ -0,0 +1,154 @@
+## Compiled ACL filters for the kNN query
+import json
+import logging
+import os
+import threading
+
+import cache
+import clients
+
+logger = logging.getLogger()
+# Must match the encoding the ingestion Lambda indexed the ACL attributes with
+acl_encoding = os.environ.get("ACL_ENCODING", "keyword")
+data_bucket_name = os.environ.get("DATA_BUCKET_NAME", "")
+vocabulary_key = os.environ.get(
+    "ACL_VOCABULARY_S3_KEY", f"{os.environ['AOS_INDEX']}-acl-vocabulary.json"
+)
+
+# Upper bound on the values a single attribute may contribute to a filter
+MAX_FILTER_VALUES = int(os.environ.get("MAX_FILTER_VALUES", "64"))
+# Matches the max_len of the Cognito custom attributes
+MAX_VALUE_LENGTH = 100
+# Vocabulary keys of the total document and passage counts, written by the
+# ingestion Lambda
+DOCUMENTS_KEY = "_documents"
+PASSAGES_KEY = "_passages"
+# ACL attribute the ingestion Lambda routed documents by, and the routing key
+# of documents without exactly one value of it
+routing_attribute = os.environ.get("ROUTING_ATTRIBUTE", "")
+SHARED_ROUTING = "_shared"
+
+compiled_filters = cache.LRUCache(
+    max_entries=1024, max_bytes=8 * 1024 * 1024, ttl_seconds=3600
+)
+_vocabulary_lock = threading.Lock()
+_vocabulary = None
+# Set when the vocabulary could not be read, selectivity is then not estimated
+_vocabulary_missing = False
+
+
+def get_vocabulary() -> dict:
+    # Value to integer code dictionary written by the ingestion Lambda
+    global _vocabulary
+    with _vocabulary_lock:
+        if _vocabulary is None:
+            response = clients.get_client("s3").get_object(
+                Bucket=data_bucket_name, Key=vocabulary_key
+            )
+            _vocabulary = json.loads(response["Body"].read().decode("utf-8"))
+            logger.info(f"ACL vocabulary loaded from s3://{data_bucket_name}/{vocabulary_key}")
+        return _vocabulary
+
+
+def reset() -> None:
+    # Called when the index is reloaded: codes and compiled filters may be stale
+    global _vocabulary, _vocabulary_missing
+    with _vocabulary_lock:
+        _vocabulary = None
+        _vocabulary_missing = False
+    compiled_filters.invalidate()
+
+
+def normalize_values(attr: str, values: list) -> list[str]:
+    # Same trimming and case folding as the ingestion Lambda applies to documents
+    normalized = set()
+    for value in values:
+        if not isinstance(value, str):
+            raise ValueError(f"Attribute {attr} has a non string value {value!r}")
+        value = value.strip().casefold()
+        if not value:
+            continue
+        if len(value) > MAX_VALUE_LENGTH or not value.isprintable():
+            raise ValueError(f"Attribute {attr} has a malformed value {value!r}")
+        normalized.add(value)
+    if len(normalized) > MAX_FILTER_VALUES:
+        raise ValueError(
+            f"Attribute {attr} has {len(normalized)} values, the limit is {MAX_FILTER_VALUES}"
+        )
+    return sorted(normalized)
+
+
+def compile_filter(user_attributes: dict[str, list]) -> dict:
+    # One terms clause per attribute, in filter context: a document must match
+    # at least one value of every attribute. An attribute left without values
+    # gets an empty terms clause and therefore matches nothing.
+    clauses = []
+    for attr in sorted(user_attributes):
+        values = normalize_values(attr, user_attributes[attr])
+        if acl_encoding == "integer":
+            # Values no document holds have no code and cannot match anything
+            codes = get_vocabulary().get(attr, {})
+            values = sorted(codes[value]["code"] for value in values if value in codes)
+        clauses.append({"terms": {attr: values}})
+    return {"bool": {"filter": clauses}}
+
+
+def get_acl_filter(user_attributes: dict[str, list]) -> dict:
+    # The compiled filter is shared by every user holding the same entitlements.
+    # Callers must not mutate it.
+    signature = cache.entitlement_signature(user_attributes)
+    acl_filter = compiled_filters.get(signature)
+    if acl_filter is None:
+        acl_filter = compile_filter(user_attributes)
+        compiled_filters.put(signature, acl_filter, len(str(acl_filter)))
+    return acl_filter
+
+
+def get_routing(acl_filter: dict) -> str:
+    # Routing keys of the shards that can hold documents matching the filter:
+    # the user's values of the routing attribute, as indexed, and the shared
+    # key. None, searching every shard, when routing is off or the filter does
+    # not restrict the routing attribute.
+    if not routing_attribute:
+        return None
+    for clause in acl_filter["bool"]["filter"]:
+        ((attr, values),) = clause["terms"].items()
+        if attr == routing_attribute:
+            return ",".join([str(value) for value in values] + [SHARED_ROUTING])
+    return None
+
+
+def get_passage_count() -> int:
+    # Vectors of the index as counted by the ingestion Lambda: one per passage
+    # when documents are chunked. Vocabularies written before passages were
+    # counted only hold the document count, None if neither is known.
+    vocabulary = get_vocabulary()
+    return vocabulary.get(PASSAGES_KEY, vocabulary.get(DOCUMENTS_KEY))
+
+
+def estimate_selectivity(user_attributes: dict[str, list]) -> float:
+    # Share of the index the user's filter lets through, from the document
+    # counts of the vocabulary, assuming independent attributes. None when the
+    # vocabulary holds no counts.
+    global _vocabulary_missing
+    if _vocabulary_missing:
+        return None
+    try:
+        vocabulary = get_vocabulary()
+    except Exception as e:
+        logger.warning(f"No ACL vocabulary to estimate the filter selectivity: {str(e)}")
+        _vocabulary_missing = True
+        return None
+    documents = vocabulary.get(DOCUMENTS_KEY)
+    if not documents:
+        return None
+    selectivity = 1.0
+    for attr, values in user_attributes.items():
+        counts = vocabulary.get(attr, {})
+        matching = sum(
+            counts[value]["doc_count"]
+            for value in normalize_values(attr, values)
+            if value in counts
+        )
+        selectivity *= min(1.0, matching / documents)
+    return selectivity
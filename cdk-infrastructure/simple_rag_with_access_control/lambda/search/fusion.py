@@ -0,0 +1,19 @@
+## Reciprocal rank fusion of result lists
+# Damps the weight of the top ranks, 60 is the value from the original RRF paper
+RANK_CONSTANT = 60
+
+
+def reciprocal_rank_fusion(
+    result_lists: list[list[dict]], size: int, rank_constant: int = RANK_CONSTANT
+) -> list[dict]:
+    # Each hit scores the sum of 1 / (rank_constant + rank) over the lists it
+    # appears in. Scores of different queries (kNN similarity, BM25) are not
+    # comparable, ranks are. Returns copies of the best `size` hits with the
+    # fused score as `_score`.
+    fused = {}
+    for hits in result_lists:
+        for rank, hit in enumerate(hits, start=1):
+            entry = fused.setdefault(hit["_id"], {"hit": hit, "score": 0.0})
+            entry["score"] += 1.0 / (rank_constant + rank)
+    best = sorted(fused.values(), key=lambda entry: entry["score"], reverse=True)[:size]
+    return [{**entry["hit"], "_score": entry["score"]} for entry in best]
@@ -0,0 +1,63 @@
+## Retrieval-confidence gating in front of the LLM
+import json
+import logging
+import os
+import threading
+
+import clients
+
+logger = logging.getLogger()
+data_bucket_name = os.environ.get("DATA_BUCKET_NAME", "")
+calibration_key = os.environ.get(
+    "SCORE_CALIBRATION_S3_KEY", f"{os.environ['AOS_INDEX']}-score-calibration.json"
+)
+# Used when the index has no calibration written by the ingestion Lambda
+default_threshold = float(os.environ.get("MIN_RELEVANCE_SCORE", "0.3"))
+
+# Same answer the prompt asks the model for when no document answers the question
+NO_ANSWER = "I don't know"
+
+_lock = threading.Lock()
+_threshold = None
+_stats = {"queries": 0, "gated": 0}
+
+
+def get_score_threshold() -> float:
+    # Hits scoring at or below the threshold are not passed to the model
+    global _threshold
+    with _lock:
+        if _threshold is None:
+            try:
+                response = clients.get_client("s3").get_object(
+                    Bucket=data_bucket_name, Key=calibration_key
+                )
+                calibration = json.loads(response["Body"].read().decode("utf-8"))
+                if not calibration.get("accepted"):
+                    raise ValueError("calibration failed its recall check")
+                _threshold = float(calibration["threshold"])
+                logger.info(f"Score threshold {_threshold} calibrated on {calibration}")
+            except Exception as e:
+                _threshold = default_threshold
+                logger.info(
+                    f"No score calibration loaded ({str(e)}), using threshold {_threshold}"
+                )
+        return _threshold
+
+
+def reset() -> None:
+    # Called when the index is reloaded, its calibration may have changed
+    global _threshold
+    with _lock:
+        _threshold = None
+
+
+def record(gated: bool) -> None:
+    with _lock:
+        _stats["queries"] += 1
+        _stats["gated"] += int(gated)
+        queries, gated_count = _stats["queries"], _stats["gated"]
+    if gated:
+        logger.info(
+            f"Retrieval gate fired, no hit above {_threshold}: "
+            f"{gated_count} of {queries} queries gated in this container"
+        )
@@ -2,55 +2,127 @@
 import json
 import logging
 import os
+import time
 import traceback
-
-import boto3
-from sagemaker.predictor import Predictor
-from sagemaker.serializers import JSONSerializer
-from sagemaker.deserializers import JSONDeserializer
-from opensearchpy import AWSV4SignerAuth, OpenSearch, RequestsHttpConnection
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+import auth
+import cache
+import clients
+import context
+import filters
+import fusion
+import gating
+import knn_policy
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 embedding_model_id = "amazon.titan-embed-text-v2:0"
 generation_model_id = "anthropic.claude-3-haiku-20240307-v1:0"
-region = os.environ["AWS_REGION"]
-domain_endpoint = os.environ["AOS_ENDPOINT"]
+# Index profile resolved by the stack, the ingestion Lambda embeds with the same dimension
+embedding_dimensions = json.loads(os.environ.get("INDEX_PROFILE", '{"dimension": 1024}'))["dimension"]
 custom_attributes = os.environ["CUSTOM_ATTRIBUTES"]
 index = os.environ["AOS_INDEX"]
-session = boto3.Session()
-
-def initialize_opensearch_client() -> OpenSearch:
-    # Create an OpenSearch client
-    credentials = session.get_credentials()
-    auth = AWSV4SignerAuth(credentials, region, "es")
-    os_client = OpenSearch(
-        hosts=[{"host": domain_endpoint, "port": 443}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-        pool_maxsize=20,
-    )
-
+local_jwt_verification = os.environ.get("LOCAL_JWT_VERIFICATION", "False") == "True"
+# Search a snapshot of the index in process instead of the OpenSearch domain.
+# NumPy is only imported when it is enabled.
+local_index_enabled = bool(os.environ.get("LOCAL_INDEX", ""))
+if local_index_enabled:
+    import local_index
+# Fuse a BM25 match on the document text with the kNN results, the local
+# index only answers kNN queries
+hybrid_search = os.environ.get("HYBRID_SEARCH", "False") == "True" and not local_index_enabled
+# Share of the question's terms a document must hold to count as a keyword hit
+keyword_minimum_should_match = os.environ.get("KEYWORD_MINIMUM_SHOULD_MATCH", "75%")
+# Hits passed to the prompt, and hits fetched per query in hybrid mode
+SEARCH_SIZE = 5
+CANDIDATE_SIZE = 10
+# Only these fields are read from the hits, leave the vectors on the cluster
+SOURCE_FIELDS = ["doc_text", "parent_id", "passage_index"]
+# Shared by warm invocations, sized for the independent calls of one request
+executor = ThreadPoolExecutor(max_workers=4)
+# Embedding and generation calls of batch requests, kept apart from the pool above.
+# A batch must answer within the 29 s API Gateway timeout: two waves of
+# generations fit, prompts still unanswered at the deadline get a timeout result.
+BATCH_MAX_PROMPTS = int(os.environ.get("BATCH_MAX_PROMPTS", "16"))
+BATCH_DEADLINE_SECONDS = float(os.environ.get("BATCH_DEADLINE_SECONDS", "25"))
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("BATCH_CONCURRENCY", "8"))
+)
+# Upper bound on the prompt tokens spent on retrieved documents
+context_token_budget = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))
+# Query embeddings, reused across users since they do not depend on entitlements
+embedding_cache_ttl = int(os.environ.get("EMBEDDING_CACHE_TTL", "86400"))
+embedding_cache = cache.EmbeddingCache(
+    cache.LRUCache(
+        max_entries=int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "2048")),
+        max_bytes=int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+        ttl_seconds=embedding_cache_ttl,
+    ),
+    cache.create_shared_tier(
+        os.environ.get("EMBEDDING_CACHE_URL", ""), embedding_cache_ttl, "emb:"
+    ),
+)
+# Answers, partitioned by the entitlement signature of the user who asked
+answer_cache = cache.AnswerCache(
+    cache.LRUCache(
+        max_entries=int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "512")),
+        max_bytes=int(os.environ.get("ANSWER_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+        ttl_seconds=int(os.environ.get("ANSWER_CACHE_TTL", "3600")),
+    ),
+    similarity_threshold=float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0")),
+)
+# Seconds between reads of the index generation written by the ingestion Lambda
+INDEX_GENERATION_TTL = 60
+# Seconds between messages pushed to a WebSocket client while streaming
+STREAM_FLUSH_INTERVAL = 0.05
+# Users verified when their WebSocket connection opened, by connection id. A
+# message sent with the same token within the TTL is not verified again, so
+# the first question of a connection costs one Cognito call, not two.
+verified_connections = cache.LRUCache(
+    max_entries=1024,
+    max_bytes=4 * 1024 * 1024,
+    ttl_seconds=int(os.environ.get("WEBSOCKET_VERIFIED_TTL", "10")),
+)
+index_generation = {"value": None, "checked_at": 0.0}
+
+
+def refresh_index_generation() -> None:
+    # Drop cached answers once the index has been reloaded since they were stored
+    if time.monotonic() - index_generation["checked_at"] < INDEX_GENERATION_TTL:
+        return
+    index_generation["checked_at"] = time.monotonic()
     try:
-        response = os_client.info()
-        logger.info(
-            f"Connection to OpenSearch successful. Cluster name: {response['cluster_name']}"
+        response = clients.get_client("ssm").get_parameters(
+            Names=[f"IndexGeneration-{index}"]
         )
-        return os_client
+        parameters = response["Parameters"]
+        value = parameters[0]["Value"] if parameters else None
     except Exception as e:
-        logger.error(
-            f"Connection to OpenSearch failed {domain_endpoint}. Detailed error: {str(e)}"
-        )
+        logger.warning(f"Failed to read the index generation: {str(e)}")
+        return
+    if value != index_generation["value"]:
+        logger.info(f"Index {index} generation is {value}, invalidating the answer cache")
+        answer_cache.invalidate()
+        filters.reset()
+        gating.reset()
+        knn_policy.reset()
+        if local_index_enabled:
+            local_index.reset()
+        index_generation["value"] = value
 
 
 def generate_embdeddings(model_provider: str, model_id: str, text: str) -> list[float]:
     # Generate embeddings for the user query
+    cache_key = cache.EmbeddingCache.make_key(text, model_id, embedding_dimensions)
+    embedding = embedding_cache.get(cache_key)
+    if embedding is not None:
+        return embedding
 
     if model_provider == "bedrock":
-        bedrock_runtime = session.client("bedrock-runtime")
-        body = json.dumps({"inputText": text, "dimensions": 1024})
+        bedrock_runtime = clients.get_client("bedrock-runtime")
+        body = json.dumps({"inputText": text, "dimensions": embedding_dimensions})
 
         response = bedrock_runtime.invoke_model(
             body=body, modelId=model_id, accept="*/*", contentType="application/json"
@@ -62,17 +134,32 @@ def generate_embdeddings(model_provider: str, model_id: str, text: str) -> list[
     else:
         raise ValueError(f"Model provider {model_provider} is not supported.")
 
+    embedding_cache.put(cache_key, embedding)
     return embedding
 
 
-def get_user_attributes(user_authorization: str) -> dict[str, list]:
+def get_user_attributes(
+    user_authorization: str, id_token: str = None
+) -> dict[str, list]:
+    custom_attr_list = custom_attributes.split(",")
+
+    if local_jwt_verification and id_token:
+        # Verify the ID token against the cached JWKS and read the custom
+        # attributes from its claims, saving the Cognito round trip
+        claims = auth.verify_id_token(id_token)
+        user_attr = auth.get_user_attributes_from_claims(claims, custom_attr_list)
+        if user_attr is not None:
+            logger.info(
+                f"A new query has been submitted by {claims['cognito:username']}"
+            )
+            return user_attr
+        logger.info("ID token is missing custom attributes, falling back to GetUser")
+
     try:
-        cognito = session.client("cognito-idp")
+        cognito = clients.get_client("cognito-idp")
         response = cognito.get_user(AccessToken=user_authorization)
         user_attr = {}
 
-        custom_attr_list = custom_attributes.split(",")
-
         for item in response["UserAttributes"]:
             if (
                 item["Name"].startswith("custom:")
@@ -97,67 +184,221 @@ def get_user_attributes(user_authorization: str) -> dict[str, list]:
         raise e
 
 
-def query_os(search_query: str, user_attributes: dict[str, list]) -> list[dict]:
-    query_vector = generate_embdeddings(
-        model_provider="bedrock",
-        model_id=embedding_model_id,
-        text=search_query,
-    )
-
-    must_conditions = []
-    for attr, values in user_attributes.items():
-        must_conditions.append(
-            {
-                "bool": {
-                    "should": [{"term": {attr: value}} for value in values],
-                    "minimum_should_match": 1,
-                }
-            }
-        )
-
-    query = {
-        "size": 5,
+def get_user_attributes_and_embeddings(
+    user_authorization: str, search_query: str, id_token: str = None
+) -> tuple[dict[str, list], list[float]]:
+    # The Cognito lookup and the query embedding do not depend on each other,
+    # so both calls are started at once and joined before the kNN query
+    futures = [
+        executor.submit(get_user_attributes, user_authorization, id_token),
+        executor.submit(
+            generate_embdeddings,
+            model_provider="bedrock",
+            model_id=embedding_model_id,
+            text=search_query,
+        ),
+    ]
+    done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in done:
+        if future.exception() is not None:
+            # Drop the sibling call: it is cancelled if not started yet, otherwise
+            # its result is discarded when it completes
+            for other in pending:
+                other.cancel()
+            raise future.exception()
+
+    return futures[0].result(), futures[1].result()
+
+
+def build_search_queries(
+    search_query: str, query_vector: list[float], acl_filter: dict, k: int = 10
+) -> list[dict]:
+    # The filtered kNN query, followed in hybrid mode by a BM25 match on the
+    # document text under the same ACL filter
+    size = CANDIDATE_SIZE if hybrid_search else SEARCH_SIZE
+    knn_query = {
+        "size": size,
+        "_source": {"includes": SOURCE_FIELDS},
         "query": {
             "knn": {
                 "doc_embedding": {
                     "vector": query_vector,
-                    "k": 10,
-                    "filter": {"bool": {"must": must_conditions}},
+                    "k": max(k, size),
+                    "filter": acl_filter,
                 }
             }
         },
     }
+    if not hybrid_search:
+        return [knn_query]
 
-    os_client = initialize_opensearch_client()
+    keyword_query = {
+        "size": CANDIDATE_SIZE,
+        "_source": {"includes": SOURCE_FIELDS},
+        "query": {
+            "bool": {
+                "must": [
+                    {
+                        "match": {
+                            "doc_text": {
+                                "query": search_query,
+                                "minimum_should_match": keyword_minimum_should_match,
+                            }
+                        }
+                    }
+                ],
+                "filter": [acl_filter],
+            }
+        },
+    }
+    return [knn_query, keyword_query]
+
+
+def msearch(os_client, queries: list[dict], routing: str = None) -> list[dict]:
+    # One round trip for all queries, responses come back in the same order
+    header = {"index": index}
+    if routing is not None:
+        header["routing"] = routing
+    body = []
+    for query in queries:
+        body.extend([header, query])
+    return os_client.msearch(body=body)["responses"]
+
+
+def run_searches(queries: list[dict], routing: str = None) -> list[dict]:
+    # Responses in query order, from the local index when enabled, otherwise
+    # from OpenSearch in one round trip, limited to the shards of the routing
+    # keys if given
+    if local_index_enabled:
+        return [local_index.search(query) for query in queries]
+    os_client = clients.get_opensearch_client()
+    try:
+        if len(queries) == 1:
+            return [os_client.search(body=queries[0], index=index, routing=routing)]
+        return msearch(os_client, queries, routing)
+    except Exception as e:
+        clients.report_opensearch_failure(e)
+        raise
 
-    response = os_client.search(body=query, index=index)
-    docs = []
 
-    if response["hits"]["max_score"] and response["hits"]["max_score"] > 0.3:
-        for hit in response["hits"]["hits"]:
-            if hit["_score"] > 0.3:
-                doc = {
-                    "doc_name": hit["_id"],
-                    "score": hit["_score"],
-                    "doc_content": hit["_source"]["doc_text"],
-                }
-                docs.append(doc)
-    return docs
+def search_prompts(
+    prompts: list[tuple[str, list[float]]], acl_filter: dict, k: int, selectivity: float = None
+) -> list[list[dict]]:
+    # Responses to the queries of every (search query, query vector) pair, in
+    # one round trip. kNN queries that came back with fewer hits than asked
+    # for are sent again, once, with a wider k, unless the filter lets through
+    # no more than k passages: faiss then searches all of them exactly and a
+    # wider k returns the same hits. With routing, only the shards the user
+    # may read documents from are searched.
+    routing = filters.get_routing(acl_filter)
+    queries = [build_search_queries(query, vector, acl_filter, k) for query, vector in prompts]
+    flat_responses = iter(run_searches([search for searches in queries for search in searches], routing))
+    responses = [[next(flat_responses) for _ in searches] for searches in queries]
+
+    wider_k = knn_policy.widen(k)
+    if selectivity is not None and selectivity * filters.get_passage_count() <= k:
+        wider_k = None
+    short = [
+        position
+        for position, (knn_response, *_) in enumerate(responses)
+        if wider_k
+        and "error" not in knn_response
+        and len(knn_response["hits"]["hits"]) < queries[position][0]["size"]
+    ]
+    if short:
+        logger.info(f"{len(short)} kNN searches returned too few hits at k={k}, retrying at k={wider_k}")
+        retries = run_searches(
+            [build_search_queries(*prompts[position], acl_filter, wider_k)[0] for position in short],
+            routing,
+        )
+        for position, knn_response in zip(short, retries):
+            responses[position][0] = knn_response
+    return responses
+
+
+def select_hits(responses: list[dict], threshold: float) -> list[dict]:
+    # Responses to the queries of build_search_queries. kNN hits are gated on
+    # their calibrated score, keyword hits on the terms they match.
+    knn_response = responses[0]
+    if "error" in knn_response:
+        raise RuntimeError(f"kNN query failed: {knn_response['error']}")
+    knn_hits = [hit for hit in knn_response["hits"]["hits"] if hit["_score"] > threshold]
+    if not hybrid_search:
+        return knn_hits
+
+    keyword_response = responses[1]
+    keyword_hits = []
+    if "error" in keyword_response:
+        logger.warning(f"Keyword query failed, using kNN hits only: {keyword_response['error']}")
+    else:
+        keyword_hits = keyword_response["hits"]["hits"]
+    logger.info(f"Hybrid search: {len(knn_hits)} kNN hits, {len(keyword_hits)} keyword hits")
+    return fusion.reciprocal_rank_fusion([knn_hits, keyword_hits], SEARCH_SIZE)
+
+
+def query_os(
+    search_query: str,
+    user_attributes: dict[str, list],
+    query_vector: list[float] = None,
+) -> list[dict]:
+    if query_vector is None:
+        query_vector = generate_embdeddings(
+            model_provider="bedrock",
+            model_id=embedding_model_id,
+            text=search_query,
+        )
 
+    selectivity = filters.estimate_selectivity(user_attributes)
+    (responses,) = search_prompts(
+        [(search_query, query_vector)],
+        filters.get_acl_filter(user_attributes),
+        knn_policy.choose_k(selectivity),
+        selectivity,
+    )
+    hits = select_hits(responses, gating.get_score_threshold())
+    return group_passages(hits) if hits else []
+
+
+def group_passages(hits: list[dict]) -> list[dict]:
+    # Passages of the same document are merged in document order under the
+    # document's best score, documents indexed whole are kept as they are.
+    # Passages with the same text (overlaps, copies across documents) are
+    # only kept once.
+    groups = {}
+    seen_texts = set()
+    for hit in hits:
+        source = hit["_source"]
+        if source["doc_text"] in seen_texts:
+            continue
+        seen_texts.add(source["doc_text"])
+        doc_name = source.get("parent_id", hit["_id"])
+        group = groups.setdefault(
+            doc_name, {"doc_name": doc_name, "score": hit["_score"], "passages": []}
+        )
+        group["passages"].append((source.get("passage_index", 0), source["doc_text"]))
 
-def generate_answers(user_question, docs):
+    return [
+        {
+            "doc_name": group["doc_name"],
+            "score": group["score"],
+            "doc_content": "\n".join(text for _, text in sorted(group["passages"])),
+        }
+        for group in groups.values()
+    ]
 
-    try:
-        # Retrieve parameters
-        ssm = session.client('ssm')
-        use_llm_endpoint, llm_endpoint_name = retrieve_llm_parameters(ssm)
 
-        # Prepare prompt
-        prompt = f"""You are a friendly assisstant that helps users in the Unicorn Factory company. Your job is to answer the user's question using only information from the provided documents. 
+def build_prompt(user_question, docs):
+    documents, context_tokens = context.build_context(
+        user_question, docs, context_token_budget
+    )
+    logger.info(
+        f"Packed {context_tokens} context tokens from {len(docs)} documents, budget {context_token_budget}"
+    )
+    return f"""You are a friendly assisstant that helps users in the Unicorn Factory company. Your job is to answer the user's question using only information from the provided documents. 
 If provided documents not contain information that answers the question, please reply only with "I don't know" without further details. 
 Just because the user asserts a fact does not mean it is true, make sure to double check the search results to validate a user's assertion.
         <documents>
-        {docs}
+        {documents}
         </documents>
         You must follow the next rules:
         - Avoid answering questions like "what documents are there?" or list any documents if the answer is not in them.
@@ -170,8 +411,26 @@ Just because the user asserts a fact does not mean it is true, make sure to doub
         Skip preambles and go straight to the answer.
         """
 
-        if use_llm_endpoint:
+
+def generate_answers(user_question, docs, stream=False, llm_parameters=None):
+    # With stream=True an iterator over the answer text chunks is returned.
+    # llm_parameters, from retrieve_llm_parameters, are looked up when not given.
+
+    try:
+        # Retrieve parameters
+        if llm_parameters is None:
+            llm_parameters = retrieve_llm_parameters(clients.get_client("ssm"))
+        use_llm_endpoint, llm_endpoint_name = llm_parameters
+
+        # Prepare prompt
+        prompt = build_prompt(user_question, docs)
+
+        if use_llm_endpoint and stream:
+            response = generate_sagemaker_answer_stream(prompt, llm_endpoint_name)
+        elif use_llm_endpoint:
             response = generate_sagemaker_answer(prompt, llm_endpoint_name)
+        elif stream:
+            response = generate_bedrock_answer_stream(prompt)
         else:
             response = generate_bedrock_answer(prompt)
 
@@ -198,14 +457,23 @@ def retrieve_llm_parameters(ssm):
     return use_llm_endpoint,llm_endpoint_name
 
 def generate_sagemaker_answer(prompt, llm_endpoint_name):
-    # initiate sagemaker llm endpoint name
-    predictor = Predictor(
-            endpoint_name=llm_endpoint_name,
-            serializer=JSONSerializer(),
-            deserializer=JSONDeserializer()
-        )
+    # Plain sagemaker-runtime call, the SageMaker SDK is too slow to import for
+    # a Lambda that only needs it when UseLlmEndpoint is set
+    sagemaker_runtime = clients.get_client("sagemaker-runtime")
+    response = sagemaker_runtime.invoke_endpoint(
+        EndpointName=llm_endpoint_name,
+        Body=json.dumps(build_sagemaker_payload(prompt)),
+        ContentType="application/json",
+        Accept="application/json",
+        CustomAttributes="accept_eula=true",
+    )
+    prediction = json.loads(response["Body"].read())
+    sm_response = prediction.pop().get('generation').get('content')
+
+    return sm_response
 
-    prompt = {
+def build_sagemaker_payload(prompt, stream=False):
+    payload = {
             "inputs":  
             [
                 [
@@ -215,15 +483,47 @@ def generate_sagemaker_answer(prompt, llm_endpoint_name):
             ],
             "parameters":{"max_new_tokens":400, "top_p":0.9, "temperature":0.01}
         }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+def generate_sagemaker_answer_stream(prompt, llm_endpoint_name):
+    sagemaker_runtime = clients.get_client("sagemaker-runtime")
+    response = sagemaker_runtime.invoke_endpoint_with_response_stream(
+        EndpointName=llm_endpoint_name,
+        Body=json.dumps(build_sagemaker_payload(prompt, stream=True)),
+        ContentType="application/json",
+        CustomAttributes="accept_eula=true",
+    )
 
-        # Make a prediction
-    prediction = predictor.predict(prompt, custom_attributes="accept_eula=true")
-    sm_response = prediction.pop().get('generation').get('content')
-
-    return sm_response
-
-def generate_bedrock_answer(prompt):
-    body = json.dumps(
+    # Payload parts are arbitrary byte ranges of newline delimited JSON events
+    # ("data:{...}" server-sent event lines or bare JSON lines)
+    buffer = b""
+    for event in response["Body"]:
+        buffer += event.get("PayloadPart", {}).get("Bytes", b"")
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            text = parse_sagemaker_stream_line(line)
+            if text:
+                yield text
+    text = parse_sagemaker_stream_line(buffer)
+    if text:
+        yield text
+
+def parse_sagemaker_stream_line(line):
+    line = line.strip()
+    if line.startswith(b"data:"):
+        line = line[len(b"data:"):].strip()
+    if not line:
+        return None
+    event = json.loads(line)
+    token = event.get("token") or {}
+    if token.get("special"):
+        return None
+    return token.get("text")
+
+def build_bedrock_body(prompt):
+    return json.dumps(
         {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 400,
@@ -234,7 +534,21 @@ def generate_bedrock_answer(prompt):
         }
     )
 
-    bedrock_runtime = session.client("bedrock-runtime")
+def generate_bedrock_answer_stream(prompt):
+    bedrock_runtime = clients.get_client("bedrock-runtime")
+    response = bedrock_runtime.invoke_model_with_response_stream(
+        modelId=generation_model_id, body=build_bedrock_body(prompt)
+    )
+
+    for event in response["body"]:
+        chunk = json.loads(event["chunk"]["bytes"])
+        if chunk["type"] == "content_block_delta":
+            yield chunk["delta"].get("text", "")
+
+def generate_bedrock_answer(prompt):
+    body = build_bedrock_body(prompt)
+
+    bedrock_runtime = clients.get_client("bedrock-runtime")
 
     b_response = json.loads(
         bedrock_runtime.invoke_model(modelId=generation_model_id, body=body)
@@ -257,21 +571,254 @@ def handle_options_method():
     }
 
 
+def answer_question(authorization, query, id_token=None, stream=False, user_attributes=None):
+    # With the user's attributes already resolved only the query is embedded
+    if user_attributes is None:
+        user_attributes, query_vector = get_user_attributes_and_embeddings(
+            authorization, query, id_token
+        )
+    else:
+        query_vector = generate_embdeddings(
+            model_provider="bedrock",
+            model_id=embedding_model_id,
+            text=query,
+        )
+    refresh_index_generation()
+    signature = cache.entitlement_signature(user_attributes)
+    response = answer_cache.get(query, signature, query_vector)
+    if response is not None:
+        return iter([response]) if stream else response
+
+    docs = query_os(query, user_attributes, query_vector)
+    gating.record(gated=not docs)
+    if not docs:
+        # Nothing the user is entitled to qualifies, the model could only say so
+        return iter([gating.NO_ANSWER]) if stream else gating.NO_ANSWER
+    if stream:
+        return stream_and_cache_answer(
+            query, signature, query_vector, generate_answers(query, docs, stream=True)
+        )
+    response = generate_answers(query, docs)
+    answer_cache.put(query, signature, query_vector, response)
+    return response
+
+
+def answer_questions(authorization, queries, id_token=None):
+    # Batch mode: the user and the LLM parameters are resolved once, the
+    # prompts are embedded on the bounded batch pool, all searches share one
+    # _msearch (plus one for those retried with a wider k) and the answers are
+    # generated in parallel. Results are in prompt order, a failed prompt only
+    # fails its own result.
+    deadline = time.monotonic() + BATCH_DEADLINE_SECONDS
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        raise ValueError("prompts must be a list of strings")
+    if not queries or len(queries) > BATCH_MAX_PROMPTS:
+        raise ValueError(f"A batch holds from 1 to {BATCH_MAX_PROMPTS} prompts")
+    user_attributes = get_user_attributes(authorization, id_token)
+    refresh_index_generation()
+    signature = cache.entitlement_signature(user_attributes)
+    acl_filter = filters.get_acl_filter(user_attributes)
+
+    results = [None] * len(queries)
+    embeddings = [
+        batch_executor.submit(
+            generate_embdeddings,
+            model_provider="bedrock",
+            model_id=embedding_model_id,
+            text=query,
+        )
+        for query in queries
+    ]
+    searches = []
+    for position, (query, embedding) in enumerate(zip(queries, embeddings)):
+        try:
+            query_vector = batch_result(embedding, deadline)
+        except Exception as e:
+            results[position] = error_result(e)
+            continue
+        response = answer_cache.get(query, signature, query_vector)
+        if response is not None:
+            results[position] = {"type": "ai", "content": response}
+            continue
+        searches.append((position, query, query_vector))
+
+    generations = []
+    if searches:
+        selectivity = filters.estimate_selectivity(user_attributes)
+        responses = search_prompts(
+            [(query, query_vector) for _, query, query_vector in searches],
+            acl_filter,
+            knn_policy.choose_k(selectivity),
+            selectivity,
+        )
+        threshold = gating.get_score_threshold()
+        # One SSM lookup for the whole batch, once a prompt needs an answer
+        llm_parameters = None
+        for (position, query, query_vector), query_responses in zip(searches, responses):
+            try:
+                hits = select_hits(query_responses, threshold)
+            except Exception as e:
+                results[position] = error_result(e)
+                continue
+            docs = group_passages(hits) if hits else []
+            gating.record(gated=not docs)
+            if not docs:
+                results[position] = {"type": "ai", "content": gating.NO_ANSWER}
+                continue
+            if llm_parameters is None:
+                llm_parameters = retrieve_llm_parameters(clients.get_client("ssm"))
+            generations.append(
+                (
+                    position,
+                    query,
+                    query_vector,
+                    batch_executor.submit(generate_answers, query, docs, llm_parameters=llm_parameters),
+                )
+            )
+
+    for position, query, query_vector, generation in generations:
+        try:
+            response = batch_result(generation, deadline)
+        except Exception as e:
+            results[position] = error_result(e)
+            continue
+        answer_cache.put(query, signature, query_vector, response)
+        results[position] = {"type": "ai", "content": response}
+    return results
+
+
+def batch_result(future, deadline: float):
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FuturesTimeoutError:
+        # Calls not started yet are dropped, running ones finish in the background
+        future.cancel()
+        raise TimeoutError(
+            f"the batch did not answer this prompt within {BATCH_DEADLINE_SECONDS:g} s, "
+            "send it again or in a smaller batch"
+        )
+
+
+def error_result(e: Exception) -> dict:
+    return {"type": "error", "content": f"Opps... something's gone wrong. Check with Unicorn admin. Error message: {str(e)}."}
+
+
+def stream_and_cache_answer(query, signature, query_vector, chunks):
+    answer = []
+    for chunk in chunks:
+        answer.append(chunk)
+        yield chunk
+    answer_cache.put(query, signature, query_vector, "".join(answer))
+
+
+def coalesce_chunks(chunks, interval=STREAM_FLUSH_INTERVAL):
+    # The first chunk goes out immediately, later ones are batched so the number
+    # of messages stays bounded however fine grained the model stream is
+    buffer = []
+    last_flush = None
+    for chunk in chunks:
+        buffer.append(chunk)
+        if last_flush is None or time.monotonic() - last_flush >= interval:
+            yield "".join(buffer)
+            buffer = []
+            last_flush = time.monotonic()
+    if buffer:
+        yield "".join(buffer)
+
+
+def handle_websocket_event(event):
+    # Streaming search over the API Gateway WebSocket API: the client connects
+    # with ?accessToken=...&idToken=..., sends {"prompt": ..., "accessToken": ...,
+    # "idToken": ...} and receives "chunk" messages as tokens arrive, followed
+    # by an "end" or "error" message. One connection serves every question of
+    # a session.
+    request_context = event["requestContext"]
+    if request_context["routeKey"] == "$connect":
+        # Browsers cannot set headers on a WebSocket, the tokens come in the query string
+        params = event.get("queryStringParameters") or {}
+        try:
+            user_attributes = get_user_attributes(params["accessToken"], params.get("idToken"))
+        except Exception as e:
+            logger.warning(f"WebSocket connection refused: {str(e)}")
+            return {"statusCode": 401}
+        verified_connections.put(
+            request_context["connectionId"],
+            (params["accessToken"], user_attributes),
+            len(params["accessToken"]) + len(json.dumps(user_attributes)),
+        )
+        return {"statusCode": 200}
+    if request_context["routeKey"] == "$disconnect":
+        verified_connections.invalidate(request_context["connectionId"])
+        return {"statusCode": 200}
+
+    management_api = clients.get_client(
+        "apigatewaymanagementapi",
+        endpoint_url=f"https://{request_context['domainName']}/{request_context['stage']}",
+    )
+
+    def send(message):
+        management_api.post_to_connection(
+            ConnectionId=request_context["connectionId"],
+            Data=json.dumps(message).encode("utf-8"),
+        )
+
+    try:
+        body = json.loads(event["body"])
+        # Connections are kept open across questions and tokens may have expired
+        # since. They are checked before the query is embedded, so that messages
+        # without a valid token cost no Bedrock call and never reach the caches,
+        # unless the connection was opened with the same token moments ago.
+        verified = verified_connections.get(request_context["connectionId"])
+        if verified is not None and verified[0] == body["accessToken"]:
+            user_attributes = verified[1]
+        else:
+            user_attributes = get_user_attributes(body["accessToken"], body.get("idToken"))
+        chunks = answer_question(
+            body["accessToken"],
+            body["prompt"],
+            body.get("idToken"),
+            stream=True,
+            user_attributes=user_attributes,
+        )
+        for chunk in coalesce_chunks(chunks):
+            send({"type": "chunk", "content": chunk})
+        send({"type": "end"})
+    except Exception as e:
+        logger.error(
+            f"Streaming search failed with the following error: {str(e)}"
+        )
+        logger.error(
+            f"Traceback: {traceback.format_exc()}"
+        )
+        send(error_result(e))
+
+    return {"statusCode": 200}
+
+
 def handler(event, context):
     # Get event content
+    if "connectionId" in event.get("requestContext", {}):
+        return handle_websocket_event(event)
+
     if event["httpMethod"] == "OPTIONS":
         return handle_options_method()
 
     try: 
         authorization = event["headers"]["x-access-token"]
+        id_token = event["headers"].get("Authorization")
 
         body = json.loads(event["body"])
-        query = body["prompt"]
-
-        user_attributes = get_user_attributes(authorization)
-        docs = query_os(query, user_attributes)
-        response = generate_answers(query, docs)
-        result = {"type": "ai", "content": response}
+        if "prompts" in body:
+            # {"prompts": [...]} answers every prompt for the same user
+            results = answer_questions(authorization, body["prompts"], id_token)
+            result = {"type": "batch", "results": results}
+        else:
+            response = answer_question(authorization, body["prompt"], id_token)
+            result = {"type": "ai", "content": response}
+        logger.info(
+            f"Embedding cache stats: {embedding_cache.stats()}, "
+            f"answer cache stats: {answer_cache.stats()}"
+        )
     except Exception as e:
         logger.error(
             f"Search failed with the following error: {str(e)}"
@@ -279,7 +826,7 @@ def handler(event, context):
         logger.error(
             f"Traceback: {traceback.format_exc()}"
         )
-        result = {"type": "error", "content": f"Opps... something's gone wrong. Check with Unicorn admin. Error message: {str(e)}."}
+        result = error_result(e)
 
     return {
         "statusCode": 200,
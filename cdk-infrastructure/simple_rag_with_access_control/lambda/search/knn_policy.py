@@ -0,0 +1,69 @@
+## kNN search depth chosen per query from the selectivity of the ACL filter
+import json
+import logging
+import os
+import threading
+
+import clients
+
+logger = logging.getLogger()
+data_bucket_name = os.environ.get("DATA_BUCKET_NAME", "")
+policy_key = os.environ.get("KNN_POLICY_S3_KEY", f"{os.environ['AOS_INDEX']}-knn-policy.json")
+
+# Used until benchmarks/knn_tuner.py has written a policy for the index. The
+# faiss engine searches at least k candidates, and searches the filtered
+# documents exactly when there are fewer of them than k, so narrow filters
+# get a larger k.
+DEFAULT_POLICY = {
+    "bands": [
+        {"max_selectivity": 0.01, "k": 100},
+        {"max_selectivity": 0.1, "k": 40},
+        {"max_selectivity": 1.0, "k": 10},
+    ],
+    "widen_factor": 4,
+    "max_k": 400,
+}
+
+_lock = threading.Lock()
+_policy = None
+
+
+def get_policy() -> dict:
+    global _policy
+    with _lock:
+        if _policy is None:
+            try:
+                response = clients.get_client("s3").get_object(Bucket=data_bucket_name, Key=policy_key)
+                _policy = json.loads(response["Body"].read().decode("utf-8"))
+                logger.info(f"kNN policy loaded from s3://{data_bucket_name}/{policy_key}: {_policy}")
+            except Exception as e:
+                _policy = DEFAULT_POLICY
+                logger.info(f"No kNN policy loaded ({str(e)}), using the default one")
+        return _policy
+
+
+def reset() -> None:
+    # Called when the index is reloaded, its policy may have been tuned again
+    global _policy
+    with _lock:
+        _policy = None
+
+
+def choose_k(selectivity: float) -> int:
+    # k of the narrowest band holding the selectivity, the broadest without estimate
+    bands = get_policy()["bands"]
+    if selectivity is None:
+        return bands[-1]["k"]
+    for band in bands:
+        if selectivity <= band["max_selectivity"]:
+            return band["k"]
+    return bands[-1]["k"]
+
+
+def widen(k: int) -> int:
+    # k of the second attempt of a search that returned too few hits, None
+    # when k is already at its maximum
+    policy = get_policy()
+    if k >= policy["max_k"]:
+        return None
+    return min(k * policy["widen_factor"], policy["max_k"])
@@ -0,0 +1,172 @@
+## In-process kNN search over an index snapshot, for small corpora
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+import clients
+
+logger = logging.getLogger()
+data_bucket_name = os.environ.get("DATA_BUCKET_NAME", "")
+# Absolute path of a snapshot directory, or its prefix in the data bucket
+snapshot_location = os.environ.get("LOCAL_INDEX", "")
+DOWNLOAD_DIRECTORY = "/tmp/local-index"
+
+SNAPSHOT_VERSION = 1
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+# Below this share of allowed rows, only those rows are scored
+GATHER_RATIO = 0.25
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Snapshot:
+    """Index snapshot written by the ingestion Lambda (see its snapshot.py).
+
+    The vector matrix is memory-mapped when float32 and decoded to float32
+    once otherwise (float16, or int8 with per-row scales), as CPUs have no
+    fast arithmetic on those. One bitset of rows is built per value of every
+    ACL attribute from the dictionary-encoded ACL table.
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "header.json"), "r") as file:
+            header = json.load(file)
+        if header["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot version {header['version']} is not supported")
+        for name, checksum in header["checksums"].items():
+            if file_digest(os.path.join(directory, name)) != checksum:
+                raise ValueError(f"Snapshot file {name} does not match its checksum")
+        self.count = header["count"]
+        self.space_type = header["space_type"]
+        if not self.count:
+            raise ValueError(f"Snapshot at {directory} holds no documents")
+        vectors = np.memmap(
+            os.path.join(directory, "vectors.bin"),
+            dtype=DTYPES[header["dtype"]],
+            mode="r",
+            shape=(self.count, header["dimension"]),
+        )
+        if vectors.dtype == np.float32:
+            self.vectors = vectors
+        else:
+            self.vectors = vectors.astype(np.float32)
+        if header["dtype"] == "int8":
+            scales = np.fromfile(os.path.join(directory, "scales.bin"), dtype=np.float32)
+            self.vectors *= scales[:, None]
+        self.norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+
+        with open(os.path.join(directory, "docs.json"), "r") as file:
+            self.docs = json.load(file)
+        with open(os.path.join(directory, "acl.json"), "r") as file:
+            acl = json.load(file)
+        self.bitsets = {}
+        for attr, table in acl.items():
+            bits = np.zeros((len(table["values"]), self.count), dtype=bool)
+            for row, codes in enumerate(table["rows"]):
+                bits[codes, row] = True
+            packed = np.packbits(bits, axis=1)
+            self.bitsets[attr] = {value: packed[code] for code, value in enumerate(table["values"])}
+        logger.info(
+            f"Snapshot of {self.count} rows loaded from {directory}, "
+            f"{header['dtype']} vectors of dimension {header['dimension']}"
+        )
+
+    def allowed_rows(self, acl_filter: dict) -> np.ndarray:
+        # Evaluates a filter from filters.compile_filter: the bitsets of the
+        # values of one terms clause are ORed, the clauses are ANDed
+        allowed = np.full((self.count + 7) // 8, 0xFF, dtype=np.uint8)
+        for clause in acl_filter["bool"]["filter"]:
+            ((attr, values),) = clause["terms"].items()
+            matching = np.zeros_like(allowed)
+            for value in values:
+                bitset = self.bitsets.get(attr, {}).get(value)
+                if bitset is not None:
+                    matching |= bitset
+            allowed &= matching
+        return np.flatnonzero(np.unpackbits(allowed, count=self.count))
+
+    def search(self, query_vector: list[float], acl_filter: dict, k: int) -> list[dict]:
+        # Exact top k of the allowed rows, scored like the OpenSearch faiss engine
+        rows = self.allowed_rows(acl_filter)
+        if not rows.size:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        if rows.size < GATHER_RATIO * self.count:
+            dots = self.vectors[rows] @ query
+        else:
+            dots = (self.vectors @ query)[rows]
+        if self.space_type == "innerproduct":
+            scores = np.where(dots >= 0, 1 + dots, 1 / (1 - dots))
+        else:
+            distances = np.maximum(self.norms[rows] - 2 * dots + query @ query, 0)
+            scores = 1 / (1 + distances)
+        k = min(k, rows.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        hits = []
+        for position in top:
+            row = rows[position]
+            source = {"doc_text": self.docs["texts"][row]}
+            if self.docs["parent_ids"][row] is not None:
+                source["parent_id"] = self.docs["parent_ids"][row]
+                source["passage_index"] = self.docs["passage_indexes"][row]
+            hits.append({"_id": self.docs["ids"][row], "_score": float(scores[position]), "_source": source})
+        return hits
+
+
+def download_snapshot(prefix: str) -> str:
+    s3 = clients.get_client("s3")
+    os.makedirs(DOWNLOAD_DIRECTORY, exist_ok=True)
+    header_path = os.path.join(DOWNLOAD_DIRECTORY, "header.json")
+    s3.download_file(data_bucket_name, f"{prefix}header.json", header_path)
+    with open(header_path, "r") as file:
+        names = json.load(file)["checksums"]
+    for name in names:
+        # Files are written aside and renamed, mappings of a previous snapshot stay valid
+        s3.download_file(data_bucket_name, f"{prefix}{name}", os.path.join(DOWNLOAD_DIRECTORY, name))
+    logger.info(f"Snapshot downloaded from s3://{data_bucket_name}/{prefix}")
+    return DOWNLOAD_DIRECTORY
+
+
+def get_snapshot() -> Snapshot:
+    global _snapshot
+    with _lock:
+        if _snapshot is None:
+            directory = snapshot_location
+            if not directory.startswith("/"):
+                directory = download_snapshot(snapshot_location)
+            _snapshot = Snapshot(directory)
+        return _snapshot
+
+
+def reset() -> None:
+    # Called when the index is reloaded, the snapshot is fetched again on next use
+    global _snapshot
+    with _lock:
+        _snapshot = None
+
+
+def search(query: dict) -> dict:
+    # Answers a kNN query body built for OpenSearch with a response of the same shape
+    knn = query["query"]["knn"]["doc_embedding"]
+    hits = get_snapshot().search(knn["vector"], knn["filter"], min(knn["k"], query["size"]))
+    return {
+        "hits": {
+            "max_score": hits[0]["_score"] if hits else None,
+            "hits": hits,
+        }
+    }
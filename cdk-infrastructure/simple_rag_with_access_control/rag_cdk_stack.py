@@ -7,6 +7,7 @@ from pathlib import Path
 
 from aws_cdk import Duration, RemovalPolicy, Stack
 from aws_cdk import aws_apigateway as apigateway
+from aws_cdk import aws_apigatewayv2 as apigatewayv2
 from aws_cdk import aws_cognito as cognito
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_lambda as _lambda
@@ -15,6 +16,7 @@ from aws_cdk import aws_s3 as s3
 from aws_cdk import aws_s3_deployment as s3deploy
 from aws_cdk import aws_ssm as ssm
 from aws_cdk import aws_sagemaker as sagemaker
+from aws_cdk.aws_apigatewayv2_integrations import WebSocketLambdaIntegration
 from aws_cdk.aws_lambda_python_alpha import PythonFunction
 from cdklabs.generative_ai_cdk_constructs import (
   JumpStartSageMakerEndpoint,
@@ -23,6 +25,7 @@ from cdklabs.generative_ai_cdk_constructs import (
 )
 from constructs import Construct
 
+INDEX_PROFILES_PATH = Path(__file__).parent / "index_profiles.json"
 BEDROCK_MODELS = ["amazon.titan-embed-text-v2:0", "anthropic.claude-3-haiku-20240307-v1:0"]
 
 class RAGCdkStack(Stack):
@@ -36,6 +39,25 @@ class RAGCdkStack(Stack):
         self.use_sm_llm_endpoint = config['USE_SAGEMAKER_ENDPOINT_LLM'] == 'True'
         # load custom attributes for Cognito
         self.custom_attributes = config["CUSTOM_ATTRIBUTES"]
+        # Index searched, also naming the generation parameter and the S3 files
+        # (ACL vocabulary, score calibration, kNN policy) written by ingestion
+        self.index_name = config["INDEX_NAME"]
+        # Verify Cognito ID tokens locally instead of calling GetUser per search
+        self.local_jwt_verification = config.get("LOCAL_JWT_VERIFICATION", "False")
+        # Index ACL attributes as keyword values or as integer dictionary codes
+        self.acl_encoding = config.get("ACL_ENCODING", "keyword")
+        # Fuse BM25 keyword hits with the kNN hits at search time
+        self.hybrid_search = config.get("HYBRID_SEARCH", "False")
+        # Snapshot searched in process by the search Lambda instead of OpenSearch
+        self.local_index = config.get("LOCAL_INDEX", "")
+        # Vector dimension, space type, HNSW parameters and encoder of the index,
+        # given to both the ingestion and the search Lambda so that they agree
+        self.index_profile = self.load_index_profile(config.get("INDEX_PROFILE", "titan-1024-fp32"))
+        # ACL attribute documents are routed by, filtered searches then only
+        # reach the shards of the user's values
+        self.routing_attribute = config.get("ROUTING_ATTRIBUTE", "")
+        if self.routing_attribute and self.routing_attribute not in self.custom_attributes.split(","):
+            raise ValueError(f"ROUTING_ATTRIBUTE {self.routing_attribute} is not one of the CUSTOM_ATTRIBUTES")
         self.bedrock_model_arns = [f"arn:aws:bedrock:{self.region}::foundation-model/{model}" for model in BEDROCK_MODELS]
 
         # Create OpenSearch domain
@@ -67,6 +89,9 @@ class RAGCdkStack(Stack):
                 "BUCKET_NAME": data_bucket.bucket_name,
                 "AOS_ENDPOINT": prod_domain.domain_endpoint,
                 "CUSTOM_ATTRIBUTES": self.custom_attributes,
+                "ACL_ENCODING": self.acl_encoding,
+                "INDEX_PROFILE": self.index_profile,
+                "ROUTING_ATTRIBUTE": self.routing_attribute,
             },
             self.get_ingestion_lambda_policy(data_bucket, prod_domain),
         )
@@ -76,10 +101,19 @@ class RAGCdkStack(Stack):
             "simple_rag_with_access_control/lambda/search",
             {
                 "AOS_ENDPOINT": prod_domain.domain_endpoint,
-                "AOS_INDEX": "test-index-3",
+                "AOS_INDEX": self.index_name,
                 "CUSTOM_ATTRIBUTES": self.custom_attributes,
+                "USER_POOL_ID": user_pool.user_pool_id,
+                "USER_POOL_CLIENT_ID": user_pool_client.user_pool_client_id,
+                "LOCAL_JWT_VERIFICATION": self.local_jwt_verification,
+                "ACL_ENCODING": self.acl_encoding,
+                "DATA_BUCKET_NAME": data_bucket.bucket_name,
+                "HYBRID_SEARCH": self.hybrid_search,
+                "LOCAL_INDEX": self.local_index,
+                "INDEX_PROFILE": self.index_profile,
+                "ROUTING_ATTRIBUTE": self.routing_attribute,
             },
-            self.get_search_lambda_policy(user_pool, prod_domain),
+            self.get_search_lambda_policy(user_pool, prod_domain, data_bucket),
         )
 
         access_modifier_lambda = self.create_lambda_function(
@@ -93,6 +127,9 @@ class RAGCdkStack(Stack):
         api = self.create_api_gateway()
         self.create_api_methods(api, search_lambda, access_modifier_lambda, user_pool)
 
+        # Create WebSocket API that streams answers as they are generated
+        websocket_stage = self.create_websocket_api(search_lambda)
+
         # Add OpenSearch domain access policies
         self.add_opensearch_access_policies(
             prod_domain, ingestion_lambda_function, search_lambda
@@ -100,7 +137,13 @@ class RAGCdkStack(Stack):
         
         # Store parameters in SSM
         self.store_parameters_in_ssm(
-            prod_domain, user_pool, user_pool_client, data_bucket, api, self.sm_endpoint
+            prod_domain,
+            user_pool,
+            user_pool_client,
+            data_bucket,
+            api,
+            websocket_stage,
+            self.sm_endpoint,
         )
 
     def create_sagemaker_endpoint(self, id, model_id : str = 'meta-textgeneration-llama-2-13b-f', model_version : str = '2.0.1') -> JumpStartSageMakerEndpoint :
@@ -124,11 +167,18 @@ class RAGCdkStack(Stack):
     def add_to_param_store(self, id: str, name: str, value: str) -> None:
         ssm.StringParameter(self, id, parameter_name=name, string_value=value)
 
+    def load_index_profile(self, name: str) -> str:
+        profiles = json.loads(INDEX_PROFILES_PATH.read_text())
+        if name not in profiles:
+            raise ValueError(f"Unknown INDEX_PROFILE {name}, choose one of {list(profiles)}")
+        return json.dumps({"name": name, **profiles[name]})
+
     def create_opensearch_domain(self) -> aos.Domain:
         return aos.Domain(
             self,
             "AosDomain",
-            version=aos.EngineVersion.OPENSEARCH_2_11,
+            # 2.13 is the first version with faiss fp16 scalar quantization
+            version=aos.EngineVersion.OPENSEARCH_2_13,
             node_to_node_encryption=True,
             encryption_at_rest=aos.EncryptionAtRestOptions(enabled=True),
             enforce_https=True,
@@ -217,10 +267,16 @@ class RAGCdkStack(Stack):
             "IngestionLambdaExecutionPolicy",
             statements=[
                 iam.PolicyStatement(
-                    actions=["s3:GetObject"],
+                    actions=["s3:GetObject", "s3:PutObject"],
                     resources=[bucket.bucket_arn + "/*"],
                     effect=iam.Effect.ALLOW,
                 ),
+                # Missing keys are then reported as such instead of access denied
+                iam.PolicyStatement(
+                    actions=["s3:ListBucket"],
+                    resources=[bucket.bucket_arn],
+                    effect=iam.Effect.ALLOW,
+                ),
                 iam.PolicyStatement(
                     actions=[
                         "es:ESHttpPost",
@@ -236,11 +292,18 @@ class RAGCdkStack(Stack):
                     resources=self.bedrock_model_arns,
                     effect=iam.Effect.ALLOW,
                 ),
+                iam.PolicyStatement(
+                    actions=["ssm:PutParameter"],
+                    resources=[
+                        f"arn:aws:ssm:{self.region}:{self.account}:parameter/IndexGeneration-*"
+                    ],
+                    effect=iam.Effect.ALLOW,
+                ),
             ],
         )
 
     def get_search_lambda_policy(
-        self, user_pool: cognito.UserPool, domain: aos.Domain
+        self, user_pool: cognito.UserPool, domain: aos.Domain, bucket: s3.Bucket
     ) -> iam.Policy:
         statements = [
             iam.PolicyStatement(
@@ -261,6 +324,17 @@ class RAGCdkStack(Stack):
                 resources=[domain.domain_arn + "/*"],
                 effect=iam.Effect.ALLOW,
             ),
+            iam.PolicyStatement(
+                actions=["s3:GetObject"],
+                resources=[bucket.bucket_arn + "/*"],
+                effect=iam.Effect.ALLOW,
+            ),
+            # Missing keys are then reported as such instead of access denied
+            iam.PolicyStatement(
+                actions=["s3:ListBucket"],
+                resources=[bucket.bucket_arn],
+                effect=iam.Effect.ALLOW,
+            ),
             iam.PolicyStatement(
                 actions=["cognito-idp:GetUser"],
                 resources=[f"{user_pool.user_pool_arn}/*"],
@@ -279,6 +353,7 @@ class RAGCdkStack(Stack):
                 iam.PolicyStatement(
                     actions=[
                         "sagemaker:InvokeEndpoint",
+                        "sagemaker:InvokeEndpointWithResponseStream",
                     ],
                     resources=[self.sm_endpoint.endpoint_arn],
                     effect=iam.Effect.ALLOW,
@@ -364,6 +439,34 @@ class RAGCdkStack(Stack):
             source_arn=f"arn:aws:execute-api:{self.region}:{self.account}:{api.rest_api_id}/*",
         )
 
+    def create_websocket_api(
+        self, search_lambda: PythonFunction
+    ) -> apigatewayv2.WebSocketStage:
+        # The search Lambda verifies the Cognito tokens on $connect, where a
+        # non 2xx response refuses the connection, and again on every message
+        integration = WebSocketLambdaIntegration(
+            "SearchStreamIntegration", search_lambda
+        )
+        websocket_api = apigatewayv2.WebSocketApi(
+            self,
+            "SearchStreamApi",
+            description="A WebSocket API streaming search answers as they are generated.",
+            connect_route_options=apigatewayv2.WebSocketRouteOptions(
+                integration=integration
+            ),
+            default_route_options=apigatewayv2.WebSocketRouteOptions(
+                integration=integration
+            ),
+        )
+        websocket_api.grant_manage_connections(search_lambda)
+        return apigatewayv2.WebSocketStage(
+            self,
+            "SearchStreamStage",
+            web_socket_api=websocket_api,
+            stage_name="prod",
+            auto_deploy=True,
+        )
+
     def add_opensearch_access_policies(
         self,
         domain: aos.Domain,
@@ -389,6 +492,7 @@ class RAGCdkStack(Stack):
         user_pool_client: cognito.UserPoolClient,
         bucket: s3.Bucket,
         api: apigateway.RestApi,
+        websocket_stage: apigatewayv2.WebSocketStage,
         sm_endpoint: JumpStartSageMakerEndpoint, 
     ) -> None:
         self.add_to_param_store(
@@ -408,6 +512,9 @@ class RAGCdkStack(Stack):
             "APIGWInvokeEndpoint",
             f"https://{api.rest_api_id}.execute-api.{Stack.of(self).region}.amazonaws.com/prod",
         )
+        self.add_to_param_store(
+            "APIGWWebSocketEndpoint", "APIGWWebSocketEndpoint", websocket_stage.url
+        )
         
         self.add_to_param_store(
             "UseLlmEndpoint", "UseLlmEndpoint", str(self.use_sm_llm_endpoint)
@@ -0,0 +1,38 @@
+## Shared setup of the Lambda tests
+import importlib.util
+import os
+import sys
+
+import pytest
+
+LAMBDA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "simple_rag_with_access_control", "lambda"
+)
+sys.path.insert(0, os.path.join(LAMBDA_DIR, "search"))
+# After the search Lambda, whose index module is the one imported as index
+sys.path.append(os.path.join(LAMBDA_DIR, "ingestion"))
+
+# Read by the search Lambda modules at import time, no AWS call is made
+os.environ.update(
+    {
+        "AWS_REGION": "us-east-1",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AOS_ENDPOINT": "localhost",
+        "BUCKET_NAME": "test-bucket",
+        "AOS_INDEX": "test-index",
+        "CUSTOM_ATTRIBUTES": "department,access_level",
+        "USER_POOL_ID": "us-east-1_test",
+        "USER_POOL_CLIENT_ID": "test-client",
+    }
+)
+
+
+@pytest.fixture(scope="session")
+def ingestion_index():
+    # The ingestion handler module, loaded by path since the search one owns the name
+    spec = importlib.util.spec_from_file_location(
+        "ingestion_index", os.path.join(LAMBDA_DIR, "ingestion", "index.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,139 @@
+## Local verification of Cognito ID tokens, against a locally generated key set
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import auth
+import clients
+import index
+
+
+class StubJWKClient(jwt.PyJWKClient):
+    """PyJWKClient serving the key set of the test instead of fetching it."""
+
+    def __init__(self, keys: list[dict]):
+        super().__init__(f"{auth.get_issuer()}/.well-known/jwks.json", cache_jwk_set=True)
+        self.keys = keys
+        self.fetches = 0
+
+    def fetch_data(self) -> dict:
+        self.fetches += 1
+        data = {"keys": list(self.keys)}
+        self.jwk_set_cache.put(data)
+        return data
+
+
+def signing_key(kid: str) -> tuple[rsa.RSAPrivateKey, dict]:
+    # Private key, and its public JWK as published by Cognito
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    return private_key, {**jwk, "kid": kid, "alg": "RS256", "use": "sig"}
+
+
+def id_token(private_key, kid: str, **overrides) -> str:
+    now = int(time.time())
+    claims = {
+        "sub": "user-1",
+        "cognito:username": "user-1",
+        "iss": auth.get_issuer(),
+        "aud": auth.user_pool_client_id,
+        "token_use": "id",
+        "iat": now,
+        "exp": now + 3600,
+        "custom:department": "Engineering, research",
+        "custom:access_level": "public",
+    }
+    claims.update(overrides)
+    claims = {name: value for name, value in claims.items() if value is not None}
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+@pytest.fixture(scope="module")
+def key():
+    return signing_key("key-1")
+
+
+@pytest.fixture
+def jwks_client(key):
+    return StubJWKClient([key[1]])
+
+
+def test_valid_token(key, jwks_client):
+    claims = auth.verify_id_token(f"Bearer {id_token(key[0], 'key-1')}", jwks_client)
+    assert claims["cognito:username"] == "user-1"
+    assert auth.get_user_attributes_from_claims(claims, ["department", "access_level"]) == {
+        "department": ["Engineering", "research"],
+        "access_level": ["public"],
+    }
+
+
+def test_expired_token(key, jwks_client):
+    now = int(time.time())
+    token = id_token(key[0], "key-1", iat=now - 7200, exp=now - 3600)
+    with pytest.raises(jwt.ExpiredSignatureError):
+        auth.verify_id_token(token, jwks_client)
+
+
+def test_wrong_audience(key, jwks_client):
+    with pytest.raises(jwt.InvalidAudienceError):
+        auth.verify_id_token(id_token(key[0], "key-1", aud="another-client"), jwks_client)
+
+
+def test_access_token_is_rejected(key, jwks_client):
+    with pytest.raises(jwt.InvalidTokenError, match="Expected an ID token"):
+        auth.verify_id_token(id_token(key[0], "key-1", token_use="access"), jwks_client)
+
+
+def test_token_signed_by_another_key(key, jwks_client):
+    other_key, _ = signing_key("key-1")
+    with pytest.raises(jwt.InvalidSignatureError):
+        auth.verify_id_token(id_token(other_key, "key-1"), jwks_client)
+
+
+def test_rotated_kid_refetches_the_key_set(key, jwks_client):
+    auth.verify_id_token(id_token(key[0], "key-1"), jwks_client)
+    assert jwks_client.fetches == 1
+
+    # Cognito rotates its keys: the cached set does not know the new kid
+    new_key = signing_key("key-2")
+    jwks_client.keys = [new_key[1]]
+    claims = auth.verify_id_token(id_token(new_key[0], "key-2"), jwks_client)
+    assert claims["token_use"] == "id"
+    assert jwks_client.fetches == 2
+
+    with pytest.raises(jwt.PyJWKClientError):
+        auth.verify_id_token(id_token(signing_key("key-3")[0], "key-3"), jwks_client)
+
+
+class StubCognito:
+    def __init__(self):
+        self.calls = 0
+
+    def get_user(self, AccessToken):
+        self.calls += 1
+        return {
+            "Username": "user-1",
+            "UserAttributes": [
+                {"Name": "sub", "Value": "user-1"},
+                {"Name": "custom:department", "Value": "engineering"},
+                {"Name": "custom:access_level", "Value": "public,support"},
+            ],
+        }
+
+
+def test_missing_custom_claims_fall_back_to_get_user(key, jwks_client, monkeypatch):
+    cognito = StubCognito()
+    monkeypatch.setattr(index, "local_jwt_verification", True)
+    monkeypatch.setattr(auth, "get_jwks_client", lambda: jwks_client)
+    monkeypatch.setattr(clients, "get_client", lambda name: cognito)
+
+    token = id_token(key[0], "key-1", **{"custom:access_level": None})
+    user_attributes = index.get_user_attributes("access-token", token)
+    assert user_attributes == {"department": ["engineering"], "access_level": ["public", "support"]}
+    assert cognito.calls == 1
+
+    user_attributes = index.get_user_attributes("access-token", id_token(key[0], "key-1"))
+    assert user_attributes == {"department": ["Engineering", "research"], "access_level": ["public"]}
+    assert cognito.calls == 1
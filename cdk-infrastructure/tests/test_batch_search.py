@@ -0,0 +1,70 @@
+## Batch search: request validation and the response deadline
+import threading
+
+import pytest
+
+import filters
+import index
+
+
+class CachedAnswers:
+    """Answer cache holding an answer for every prompt."""
+
+    def get(self, query: str, signature: str, query_vector: list[float]) -> str:
+        return f"cached answer to {query}"
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    monkeypatch.setattr(index, "get_user_attributes", lambda *args: {"department": ["engineering"]})
+    monkeypatch.setattr(index, "refresh_index_generation", lambda: None)
+    monkeypatch.setattr(filters, "get_acl_filter", lambda user_attributes: {"bool": {"filter": []}})
+    monkeypatch.setattr(index, "answer_cache", CachedAnswers())
+    return monkeypatch
+
+
+@pytest.mark.parametrize("prompts", ["What is Unicorn Robotics?", [1, 2], {"prompt": "hi"}, []])
+def test_invalid_prompts_are_rejected(batch, prompts):
+    with pytest.raises(ValueError):
+        index.answer_questions("access-token", prompts)
+
+
+def test_too_many_prompts_are_rejected(batch):
+    with pytest.raises(ValueError):
+        index.answer_questions("access-token", ["hi"] * (index.BATCH_MAX_PROMPTS + 1))
+
+
+def test_prompts_past_the_deadline_time_out(batch):
+    released = threading.Event()
+
+    def generate_embdeddings(model_provider: str, model_id: str, text: str) -> list[float]:
+        if text == "slow":
+            released.wait(5)
+        return [1.0, 0.0]
+
+    batch.setattr(index, "generate_embdeddings", generate_embdeddings)
+    batch.setattr(index, "BATCH_DEADLINE_SECONDS", 0.2)
+    try:
+        results = index.answer_questions("access-token", ["fast", "slow", "fast again"])
+    finally:
+        released.set()
+    assert results[0] == {"type": "ai", "content": "cached answer to fast"}
+    assert results[1]["type"] == "error"
+    assert "0.2 s" in results[1]["content"]
+    assert results[2] == {"type": "ai", "content": "cached answer to fast again"}
+
+
+@pytest.mark.parametrize("selectivity, searches", [(0.01, 1), (0.05, 2), (None, 2)])
+def test_wider_retry_counts_passages(monkeypatch, selectivity, searches):
+    # 100 documents chunked into 1000 passages: 5% of the index is 5 documents
+    # but 50 passages, more than k
+    sent = []
+
+    def run_searches(queries: list[dict], routing: str = None) -> list[dict]:
+        sent.append(queries)
+        return [{"hits": {"hits": []}} for _ in queries]
+
+    monkeypatch.setattr(index, "run_searches", run_searches)
+    monkeypatch.setattr(filters, "get_vocabulary", lambda: {"_documents": 100, "_passages": 1000})
+    index.search_prompts([("question", [1.0, 0.0])], {"bool": {"filter": []}}, 10, selectivity)
+    assert len(sent) == searches
@@ -0,0 +1,48 @@
+## Search caches: memory accounting and round trips
+import sys
+
+import cache
+
+
+def test_embedding_cache_counts_packed_vectors(tmp_path):
+    shared = cache.FileCacheTier(str(tmp_path), ttl_seconds=60)
+    embeddings = cache.EmbeddingCache(cache.LRUCache(16, 1024 * 1024, 60), shared)
+    embedding = [0.5, -0.25, 0.125] * 341
+    embeddings.put("key", embedding)
+
+    # The counted bytes are the bytes held, about 4 per dimension
+    held = embeddings.local.get("key")
+    assert embeddings.local.stats()["bytes"] == sys.getsizeof(held) < 5 * len(embedding)
+    assert embeddings.get("key") == embedding
+
+    # A container missing the entry fills its local tier from the shared one
+    other = cache.EmbeddingCache(cache.LRUCache(16, 1024 * 1024, 60), shared)
+    assert other.get("key") == embedding
+    assert other.stats()["shared_hits"] == 1
+
+
+def test_answer_cache_counts_unit_vectors():
+    answers = cache.AnswerCache(cache.LRUCache(16, 1024 * 1024, 60), similarity_threshold=0.9)
+    answers.put("What is a unicorn?", "sig", [3.0, 4.0] * 512, "A robot.")
+    assert answers.local.stats()["bytes"] < sys.getsizeof("A robot.") + 5 * 1024
+    assert answers.get("what is  a UNICORN?", "sig") == "A robot."
+    assert answers.get("Tell me about unicorns", "sig", [3.0, 4.1] * 512) == "A robot."
+    assert answers.get("Tell me about unicorns", "other-sig", [3.0, 4.1] * 512) is None
+
+
+def test_semantic_lookup_follows_evictions():
+    answers = cache.AnswerCache(cache.LRUCache(2, 1024 * 1024, 60), similarity_threshold=0.9)
+    answers.put("first", "sig", [1.0, 0.0, 0.0], "first answer")
+    answers.put("second", "sig", [0.0, 1.0, 0.0], "second answer")
+    answers.put("third", "other-sig", [0.0, 0.0, 1.0], "third answer")
+
+    # "first" was evicted, its vector no longer matches
+    assert answers.get("near first", "sig", [1.0, 0.1, 0.0]) is None
+    assert answers.get("near second", "sig", [0.1, 1.0, 0.0]) == "second answer"
+    assert answers.get("near third", "other-sig", [0.0, 0.1, 1.0]) == "third answer"
+    assert sorted(answers.groups) == ["other-sig", "sig"]
+    assert answers.groups["sig"].keys == [cache.AnswerCache.make_key("second", "sig")]
+
+    answers.invalidate()
+    assert answers.groups == {}
+    assert answers.get("near second", "sig", [0.1, 1.0, 0.0]) is None
@@ -0,0 +1,54 @@
+## Embedding store shared across ingestion runs
+import json
+import os
+
+import numpy as np
+
+import vector_store
+from vector_store import EmbeddingStore, text_digest
+
+
+def vector(i: int) -> list[float]:
+    return [float(i), float(i) / 2, -float(i)]
+
+
+def test_rows_are_written_in_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "FLUSH_ROWS", 4)
+    store = EmbeddingStore(str(tmp_path), "amazon.titan-embed-text-v2:0", 3)
+    for i in range(10):
+        store.put(text_digest(f"passage {i}"), vector(i))
+    store.put(text_digest("passage 0"), vector(99))
+
+    # Only the rows of the last, partial block are held in memory
+    assert len(store.pending_vectors) == 2
+    assert os.path.getsize(os.path.join(store.directory, "vectors.bin")) == 8 * 3 * 4
+    assert [store.get(text_digest(f"passage {i}")) for i in range(10)] == [vector(i) for i in range(10)]
+
+    store.save()
+    reloaded = EmbeddingStore(str(tmp_path), "amazon.titan-embed-text-v2:0", 3)
+    reloaded.load()
+    assert reloaded.saved_count == 10
+    assert reloaded.get(text_digest("passage 9")) == vector(9)
+
+
+def test_unsaved_rows_are_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "FLUSH_ROWS", 2)
+    store = EmbeddingStore(str(tmp_path), "model", 3)
+    store.put(text_digest("kept"), vector(1))
+    store.save()
+
+    # A run interrupted after a flush but before its save
+    interrupted = EmbeddingStore(str(tmp_path), "model", 3)
+    interrupted.load()
+    for i in range(2, 6):
+        interrupted.put(text_digest(f"lost {i}"), vector(i))
+    with open(os.path.join(store.directory, "header.json")) as file:
+        assert json.load(file)["count"] == 1
+
+    resumed = EmbeddingStore(str(tmp_path), "model", 3)
+    resumed.load()
+    assert resumed.get(text_digest("lost 2")) is None
+    resumed.put(text_digest("new"), vector(7))
+    resumed.save()
+    vectors = np.fromfile(os.path.join(store.directory, "vectors.bin"), dtype=np.float32)
+    assert vectors.reshape(-1, 3).tolist() == [vector(1), vector(7)]
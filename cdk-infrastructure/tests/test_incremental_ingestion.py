@@ -0,0 +1,75 @@
+## Incremental ingestion: which documents a run re-indexes, updates or retries
+import acl
+import manifest
+from manifest import Manifest
+
+
+class RecordingIndexer:
+    """Collects the bulk actions of a run instead of sending them."""
+
+    def __init__(self):
+        self.actions = []
+
+    def add(self, action: dict, source: dict = None) -> None:
+        self.actions.append(action)
+
+    def ids(self) -> list[str]:
+        return [next(iter(action.values()))["_id"] for action in self.actions]
+
+
+def plan(ingestion_index, docs: dict, previous: Manifest) -> tuple[list, Manifest, RecordingIndexer, dict, dict]:
+    current = Manifest({})
+    indexer = RecordingIndexer()
+    stats = dict.fromkeys(["unchanged", "metadata_updated", "embedded", "deleted", "moved"], 0)
+    parents = {}
+    changed = list(
+        ingestion_index.plan_changes(
+            iter(docs.items()), previous, current, indexer, "test-index", True, stats, parents
+        )
+    )
+    return [doc_id for doc_id, _ in changed], current, indexer, stats, parents
+
+
+def test_failed_passage_update_is_retried(ingestion_index):
+    doc = {"doc_text": "Robot arm calibration", "department": ["engineering"], "access_level": ["support"]}
+    entry = {"text": manifest.hash_text(doc["doc_text"]), "metadata": manifest.hash_metadata(doc)}
+    previous = Manifest({}, {"a.txt": {**entry, "passages": 2}})
+
+    # Access revoked from engineering: a metadata-only change of a chunked document
+    revoked = {**doc, "department": ["hr"]}
+    changed, current, indexer, stats, parents = plan(ingestion_index, {"a.txt": revoked}, previous)
+    assert changed == []
+    assert stats["metadata_updated"] == 1
+    assert indexer.ids() == ["a.txt#0", "a.txt#1"]
+
+    # One passage update is rejected: the document leaves the manifest
+    failed = ingestion_index.drop_failed_documents({"a.txt#0"}, parents, previous, current, {})
+    assert failed == {"a.txt"}
+    assert "a.txt" not in current.docs
+
+    # and the next run indexes it again instead of counting it as unchanged
+    changed, _, _, stats, _ = plan(ingestion_index, {"a.txt": revoked}, current)
+    assert changed == ["a.txt"]
+    assert stats["unchanged"] == 0
+
+
+def test_unchanged_and_updated_documents(ingestion_index):
+    doc = {"doc_text": "Quarterly results", "department": ["finance"], "access_level": ["public"]}
+    entry = {"text": manifest.hash_text(doc["doc_text"]), "metadata": manifest.hash_metadata(doc)}
+    previous = Manifest({}, {"a.txt": dict(entry), "b.txt": dict(entry)})
+
+    docs = {"a.txt": doc, "b.txt": {**doc, "access_level": ["confidential"]}, "c.txt": doc}
+    changed, current, indexer, stats, parents = plan(ingestion_index, docs, previous)
+    assert changed == ["c.txt"]
+    assert stats == {"unchanged": 1, "metadata_updated": 1, "embedded": 1, "deleted": 0, "moved": 0}
+    assert indexer.ids() == ["b.txt"]
+    assert parents == {"b.txt": "b.txt"}
+    assert set(current.docs) == {"a.txt", "b.txt", "c.txt"}
+
+
+def test_vocabulary_counts_passages():
+    current = Manifest({}, {"a.txt": {"passages": 3}, "b.txt": {}, "c.txt": {"passages": 0}})
+    vocabulary = acl.AclVocabulary(["department"])
+    vocabulary.documents = 3
+    vocabulary.passages = current.passage_count()
+    assert vocabulary.to_dict() == {"department": {}, "_documents": 3, "_passages": 4}
@@ -0,0 +1,66 @@
+## Streaming search over the WebSocket API: connection and message checks
+import json
+
+import pytest
+
+import clients
+import index
+
+
+class ManagementApi:
+    """Records the messages posted to the connection."""
+
+    def __init__(self):
+        self.messages = []
+
+    def post_to_connection(self, ConnectionId: str, Data: bytes) -> None:
+        self.messages.append(json.loads(Data))
+
+
+def websocket_event(route: str, connection_id: str = "conn-1", **fields) -> dict:
+    request_context = {"routeKey": route, "connectionId": connection_id, "domainName": "ws.example", "stage": "prod"}
+    return {"requestContext": request_context, **fields}
+
+
+@pytest.fixture
+def cognito(monkeypatch):
+    calls = []
+
+    def get_user_attributes(authorization: str, id_token: str = None) -> dict:
+        calls.append(authorization)
+        if authorization == "revoked":
+            raise ValueError("Access Token has been revoked")
+        return {"department": ["engineering"]}
+
+    def answer_question(authorization, query, id_token=None, stream=False, user_attributes=None):
+        return iter([f"answer for {user_attributes['department'][0]}"])
+
+    api = ManagementApi()
+    monkeypatch.setattr(index, "get_user_attributes", get_user_attributes)
+    monkeypatch.setattr(index, "answer_question", answer_question)
+    monkeypatch.setattr(clients, "get_client", lambda *args, **kwargs: api)
+    index.verified_connections.invalidate()
+    return calls, api
+
+
+def test_first_question_reuses_the_connect_check(cognito):
+    calls, api = cognito
+    connect = websocket_event("$connect", queryStringParameters={"accessToken": "token", "idToken": "id"})
+    assert index.handler(connect, None) == {"statusCode": 200}
+    message = websocket_event("sendMessage", body=json.dumps({"prompt": "hi", "accessToken": "token"}))
+    index.handler(message, None)
+    assert calls == ["token"]
+    assert api.messages == [{"type": "chunk", "content": "answer for engineering"}, {"type": "end"}]
+
+    # A different token, or a closed connection, is verified again
+    index.handler(websocket_event("sendMessage", body=json.dumps({"prompt": "hi", "accessToken": "revoked"})), None)
+    assert api.messages[-1]["type"] == "error"
+    index.handler(websocket_event("$disconnect"), None)
+    index.handler(message, None)
+    assert calls == ["token", "revoked", "token"]
+
+
+def test_connection_with_an_invalid_token_is_refused(cognito):
+    connect = websocket_event("$connect", queryStringParameters={"accessToken": "revoked"})
+    assert index.handler(connect, None) == {"statusCode": 401}
+    assert index.verified_connections.get("conn-1") is None
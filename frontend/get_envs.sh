@@ -4,6 +4,7 @@
 API_ENDPOINT_PARAM="APIGWInvokeEndpoint"
 USER_POOL_ID_PARAM="UserPoolID"
 USER_POOL_CLIENT_ID_PARAM="UserPoolClientID"
+WEBSOCKET_ENDPOINT_PARAM="APIGWWebSocketEndpoint"
 
 # Function to get parameter value from SSM
 get_ssm_parameter() {
@@ -13,6 +14,7 @@ get_ssm_parameter() {
 API_ENDPOINT=$(get_ssm_parameter $API_ENDPOINT_PARAM)
 USER_POOL_ID=$(get_ssm_parameter $USER_POOL_ID_PARAM)
 USER_POOL_CLIENT_ID=$(get_ssm_parameter $USER_POOL_CLIENT_ID_PARAM)
+WEBSOCKET_ENDPOINT=$(get_ssm_parameter $WEBSOCKET_ENDPOINT_PARAM)
 
 # Create or overwrite the .env.development file
 cat << EOF > .env.development
@@ -20,6 +22,7 @@ VITE_REGION=$AWS_REGION
 VITE_API_ENDPOINT=$API_ENDPOINT
 VITE_USER_POOL_ID=$USER_POOL_ID
 VITE_USER_POOL_CLIENT_ID=$USER_POOL_CLIENT_ID
+VITE_WEBSOCKET_ENDPOINT=$WEBSOCKET_ENDPOINT
 EOF
 
 echo ".env.development file has been created/updated with values from SSM Parameter Store."
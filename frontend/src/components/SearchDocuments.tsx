@@ -24,14 +24,14 @@ const SearchDocuments: React.FC<SearchDocumentsProps> = ({
     <div className="flex flex-col justify-between h-full overflow-y-auto col-span-8 p-5 border-l border-gray-200">
         <div className="relative">
           <input
-            disabled={messageStatus === "loading"}
+            disabled={messageStatus !== "idle"}
             type="text"
             id="prompt"
             value={prompt}
             onChange={handlePromptChange}
             onKeyDown={handleKeyPress}
             className={
-              messageStatus === "loading"
+              messageStatus !== "idle"
                 ? "block w-full p-4 pl-4 text-sm text-gray-500 border border-gray-200 rounded-lg bg-gray-50 focus:ring-blue-500 focus:border-blue-500"
                 : "block w-full p-4 pl-4 text-sm text-gray-900 border border-gray-200 rounded-lg bg-gray-50 focus:ring-blue-500 focus:border-blue-500"
             }
@@ -48,7 +48,7 @@ const SearchDocuments: React.FC<SearchDocumentsProps> = ({
               <MagnifyingGlassIcon className="w-6 h-6" />
             </button>
           )}
-          {messageStatus === "loading" && (
+          {messageStatus !== "idle" && (
             <button
               disabled
               type="submit"
@@ -78,7 +78,7 @@ const SearchDocuments: React.FC<SearchDocumentsProps> = ({
       <div className="relative w-full pt-5">
         <div className="">
           <div className="grid gap-5">
-            {messageStatus === "idle" && searchResults && (  
+            {messageStatus !== "loading" && searchResults && (  
                 <div className="justify-self-start w-full rounded border border-gray-100 px-5 py-3.5 text-gray-800">
                   <div className="prose">
                     <ReactMarkdown>{searchResults}</ReactMarkdown>
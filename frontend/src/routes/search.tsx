@@ -1,15 +1,20 @@
-import React, { useState, useEffect, KeyboardEvent } from "react";
-import { API } from "aws-amplify";
+import React, { useState, useEffect, useRef, KeyboardEvent } from "react";
+import { API, Auth } from "aws-amplify";
 import SearchDocuments from "../components/SearchDocuments";
 
+// Answers are streamed over the WebSocket API when its endpoint is configured
+const websocketEndpoint = import.meta.env.VITE_WEBSOCKET_ENDPOINT;
+
 const Search: React.FC = () => {
 
   const [searchResult, setSearchResult] = useState<string | null>("");
   const [messageStatus, setMessageStatus] = useState<string>("idle");
   const [prompt, setPrompt] = useState("");
+  const socketRef = useRef<WebSocket | null>(null);
 
   useEffect(() => {
-    // do nothing
+    // The streaming connection is closed when leaving the page
+    return () => socketRef.current?.close();
   }, []);
 
   const handlePromptChange = (event: React.ChangeEvent<HTMLInputElement>) => {
@@ -22,9 +27,72 @@ const Search: React.FC = () => {
     }
   };
 
+  const openSocket = (accessToken: string, idToken: string): Promise<WebSocket> => {
+    // One connection per session, opened by the first question and reused by
+    // the next ones. The tokens are checked when it opens and with every message.
+    const current = socketRef.current;
+    if (current && current.readyState === WebSocket.OPEN) {
+      return Promise.resolve(current);
+    }
+    const params = new URLSearchParams({ accessToken, idToken });
+    const socket = new WebSocket(`${websocketEndpoint}?${params}`);
+    socketRef.current = socket;
+    // API Gateway closes idle connections, the next question opens a new one
+    socket.onclose = () => {
+      if (socketRef.current === socket) {
+        socketRef.current = null;
+      }
+      setMessageStatus("idle");
+    };
+    return new Promise((resolve, reject) => {
+      socket.onopen = () => resolve(socket);
+      socket.onerror = () => reject(new Error("WebSocket connection failed"));
+    });
+  };
+
+  const connectionFailed = () => {
+    setSearchResult("Opps... the connection to the search service failed. Check with Unicorn admin.");
+    setMessageStatus("idle");
+  };
+
+  const streamMessage = async () => {
+    const session = await Auth.currentSession();
+    const accessToken = session.getAccessToken().getJwtToken();
+    const idToken = session.getIdToken().getJwtToken();
+    let socket: WebSocket;
+    try {
+      socket = await openSocket(accessToken, idToken);
+    } catch {
+      connectionFailed();
+      return;
+    }
+    let answer = "";
+
+    socket.onmessage = (event) => {
+      const message = JSON.parse(event.data);
+      if (message.type === "chunk") {
+        answer += message.content;
+        setSearchResult(answer);
+        setMessageStatus("streaming");
+        return;
+      }
+      if (message.type === "error") {
+        setSearchResult(message.content);
+      }
+      setMessageStatus("idle");
+    };
+    socket.onerror = connectionFailed;
+    socket.send(JSON.stringify({ prompt, accessToken, idToken }));
+  };
+
   const submitMessage = async () => {
     setMessageStatus("loading");
 
+    if (websocketEndpoint) {
+      await streamMessage();
+      return;
+    }
+
     const response = await API.post(
       "RestApi",
       `/invoke`,